@@ -6,50 +6,194 @@ Usage:
 
 Options:
     -h, --help                                     Show this help message and exit.
-    -r, --refresh-cache                            Refresh cached user and org data from Zendesk
-    -l LEVEL, --level LEVEL                        Logging level during execution. Available options: DEBUG, INFO, WARNING, ERROR (default), CRITICAL [default: WARNING]
+    -r, --refresh-cache                            Discard cached user and org data and download it all again from Zendesk
+    -l LEVEL, --level LEVEL                        Logging level during execution. Available options: DEBUG, INFO, WARNING, ERROR, CRITICAL [default: WARNING]
     -c CONFIGFILE, --config CONFIGFILE             Provide a file containing credentials and settings [default: ./rocketsearch.yml]
     --list-channels                                Do not start the Slack bot, instead return a list of the current channels. Used to determine channel id for configuration.
+    -b FILE, --batch FILE                          Do not start the Slack bot, instead run the queries in FILE (- for stdin) and write the results to stdout as JSON Lines. Each query is a line of provider<TAB>query[<TAB>limit], or a JSON object with those keys.
+    -p N, --parallel N                             Number of --batch queries run at once [default: 4]
 """
 
-import requests, re, yaml, os, pickle, websocket
+import requests, re, yaml, os, sys, sqlite3, websocket, threading, Queue, collections, select, random, json
+import math, heapq, contextlib, BaseHTTPServer, socket, logging, calendar, datetime
+from requests.adapters import HTTPAdapter
 from docopt import docopt
 from urllib import urlencode
 from jira import JIRA, JIRAError
 from slackclient import SlackClient
-from time import sleep
-from simple_salesforce import Salesforce, SalesforceMalformedRequest
-
-def getZDOutput(credentials, subdomain, r_type, **kwargs):
-    # Use Zendesk Query API to search
-    session = requests.Session()
-    session.auth = credentials
-    print r_type
-    print kwargs, type(kwargs)
-
-    if kwargs and kwargs["params"]:
-        url = 'https://%s.zendesk.com/api/v2/%s.json?%s' % (subdomain, r_type, urlencode(kwargs["params"]))
-    else:
-        url = 'https://' + zd_domain + '.zendesk.com/api/v2/' + r_type + '.json'
-
-    data = []
+from time import sleep, time
+from simple_salesforce import Salesforce, SalesforceMalformedRequest, SalesforceExpiredSession
+
+logger = logging.getLogger("rocketsearch")
+
+# Written to stderr, by default, at the level given by --level
+log_format = "%(asctime)s %(levelname)s [%(threadName)s] %(message)s"
+
+class truncated(object):
+    # A payload in a log message, e.g. an RTM event or a reply. It's only formatted if the message is written, and
+    # then cut short at limit characters.
+    limit = 500
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    def __str__(self):
+        text = self.payload if isinstance(self.payload, basestring) else repr(self.payload)
+        if isinstance(text, unicode):
+            text = text.encode("ascii", "backslashreplace")
+        if len(text) > self.limit:
+            return "%s... (%d characters)" % (text[:self.limit], len(text))
+        return text
+
+class sample_filter(logging.Filter):
+    # Writes only one in every `every` records of each kind of per-event debug output, i.e. those logged with
+    # extra={"sample": kind}, so a busy bot's debug log stays readable. Other records all pass.
+    def __init__(self, every=1):
+        logging.Filter.__init__(self)
+        self.every = every
+        self.lock = threading.Lock()
+        self.seen = collections.Counter()
+
+    def filter(self, record):
+        kind = getattr(record, "sample", None)
+        if kind is None or self.every <= 1:
+            return True
+        with self.lock:
+            self.seen[kind] += 1
+            return self.seen[kind] % self.every == 1
+
+class json_formatter(logging.Formatter):
+    # Writes each record as a line of JSON, for log pipelines that index the fields
+    def format(self, record):
+        entry = {"time": round(record.created, 3), "level": record.levelname, "thread": record.threadName,
+                 "message": record.getMessage()}
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+# Filters run only for records at an enabled level, so sampling costs nothing when debug output is off
+log_sampling = sample_filter()
+logger.addFilter(log_sampling)
+
+class ZendeskError(Exception):
+    # Raised when a Zendesk request fails for good, either after retries or because Zendesk rejected it
+    def __init__(self, message, status=None):
+        Exception.__init__(self, message)
+        self.status = status
+
+class zendesk:
+    # Long-lived Zendesk API client. Keeps a pool of keep-alive connections shared by every worker, and retries
+    # connection errors, timeouts, 429s and 5xxs with bounded exponential backoff.
+    def __init__(self, options, pool_size):
+        self.options = options
+        self.base_url = options["url"] or "https://%s.zendesk.com" % options["subdomain"]
+        self.timeout = (options["connect_timeout"], options["read_timeout"])
+        self.session = requests.Session()
+        self.session.auth = options["credentials"]
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def url(self, r_type, params=None):
+        # Builds the API URL for a request type such as "search" or "users"
+        url = "%s/api/v2/%s.json" % (self.base_url, r_type)
+        if params:
+            url += "?" + urlencode(params)
+        return url
+
+    def get(self, url, timeout=None, retries=None):
+        # Fetches a Zendesk API URL and returns the decoded JSON. Callers with a time budget can give a single
+        # timeout and fewer retries than the configured ones.
+        if timeout is None:
+            timeout = self.timeout
+        if retries is None:
+            retries = self.options["retries"]
+        call = re.search(r'/api/v2/(.+?)\.json', url).group(1)
+        # A single timeout is the caller's whole budget, including any wait for the rate limit
+        deadline = time() + timeout if isinstance(timeout, (int, float)) else None
+        # Calls for a search stop when its reply is due, rather than holding a worker for results nobody will see
+        if searchDeadline() is not None:
+            deadline = min(deadline or searchDeadline(), searchDeadline())
+        attempt = 0
+        while True:
+            wait = None
+            if not outbound.acquire("zendesk", deadline):
+                raise ZendeskError("Rate limited by Zendesk", 429)
+            try:
+                with metrics.timed("upstream", provider="zendesk", call=call):
+                    response = self.session.get(url, timeout=cappedTimeout(timeout, deadline))
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                metrics.count("rocketsearch_upstream_requests_total", provider="zendesk", call=call, status="error")
+                error = ZendeskError(str(e))
+            else:
+                metrics.count("rocketsearch_upstream_requests_total", provider="zendesk", call=call,
+                              status=response.status_code)
+                outbound.observe("zendesk", response.status_code, response.headers)
+                if response.status_code == 200:
+                    return response.json()
+                error = ZendeskError("Status %d: %s" % (response.status_code, response.text[:200]),
+                                     response.status_code)
+                if response.status_code == 429:
+                    # The scheduler holds the retry until Zendesk's Retry-After is up
+                    wait = 0
+                elif response.status_code < 500:
+                    # Anything else in the 4xx range won't get better by asking again
+                    raise error
+            if attempt >= retries:
+                raise error
+            if wait is None:
+                # Jitter the backoff so workers that failed together don't retry together
+                wait = min(self.options["backoff"] * 2 ** attempt, self.options["max_backoff"])
+                wait = random.uniform(wait / 2, wait)
+            if deadline is not None and time() + wait >= deadline:
+                # No time left to try again
+                raise error
+            attempt += 1
+            metrics.count("rocketsearch_upstream_retries_total", provider="zendesk", call=call)
+            if wait:
+                logger.warning("Zendesk request failed (%s). Retry %d in %.1f seconds.", error, attempt, wait)
+                sleep(wait)
+            else:
+                logger.warning("Zendesk request failed (%s). Retry %d once the rate limit allows.", error, attempt)
+
+def getZDTickets(client, params, limit):
+    # Searches Zendesk for up to limit tickets. Stops requesting pages as soon as there are enough.
+    # Zendesk returns at most 100 results per page. Returns the tickets and a cursor for the rest.
+    params = dict(params, per_page=min(max(limit, 1), 100))
+    return continueZDTickets(client, {"tickets": [], "next_page": client.url("search", params)}, limit)
+
+def continueZDTickets(client, cursor, limit):
+    # Takes up to limit tickets from a cursor: the tickets already fetched but not shown, then the pages from
+    # next_page on. Returns them and a cursor for the rest, or None if there are no more.
+    tickets = list(cursor["tickets"])
+    url = cursor["next_page"]
+    while len(tickets) < limit and url:
+        page = client.get(url)
+        tickets.extend(parseZDOutput(page["results"]))
+        url = page["next_page"]
+    if len(tickets) <= limit and not url:
+        return [tickets, None]
+    return [tickets[:limit], {"tickets": tickets[limit:], "next_page": url}]
+
+def getZDTicketsById(client, ids):
+    # Reads tickets by number with one show_many call, through the record cache. Returns them in the order asked
+    # for, leaving out any that don't exist.
+    def fetch(missing):
+        url = client.url("tickets/show_many", {"ids": ",".join(str(id) for id in missing)})
+        return dict((ticket["id"], ticket) for ticket in client.get(url)["tickets"])
+    found = record_lookups.get("zendesk", ids, lambda missing: upstreams["zendesk"].call(lambda: fetch(missing)))
+    return [found[id] for id in ids if id in found]
+
+def getZDIncremental(client, r_type, start_time):
+    # Uses the Zendesk incremental export API to page through everything of r_type changed since start_time.
+    # Yields each page's entries along with the end_time to start from next time.
+    url = client.url("incremental/" + r_type, {"start_time": start_time})
     while url:
-        print url
-        response = session.get(url, timeout=10)
-        if not response:
-            print "response timed out???"
-        if response.status_code != 200:
-            print('Status:', response.status_code, 'Problem with the request. Exiting.')
-            return None
-        # Get all responses as JSON and convert to dict
-        t_data = response.json()
-        if r_type == "search":
-            data.extend(t_data['results'])
-        else:
-            data.extend(t_data[r_type])
-        url = t_data['next_page']
-    print data
-    return data
+        t_data = client.get(url)
+        yield t_data[r_type], t_data.get("end_time") or start_time
+        if t_data.get("end_of_stream") or not t_data[r_type]:
+            break
+        url = t_data["next_page"]
 
 def parseZDOutput(data):
     # Search for tickets in Zendesk query results
@@ -63,7 +207,7 @@ def parseZDOutput(data):
     return tickets
 
 def printZDData(tickets):
-    # Function to print all Zendesk results and format them for console
+    # Function to log all Zendesk results, formatted as for the console, when debugging
 
     # Fields I care about
     t_fields = ['id', 'subject', 'submitter_id','assignee_id', 'status', 'description']
@@ -71,113 +215,416 @@ def printZDData(tickets):
     for ticket in tickets:
         for field in t_fields:
             if field == "description":
-                print field.capitalize(), ": ", ticket[field][:100].replace('\n', ' ')
+                logger.debug("%s: %s", field.capitalize(), truncated(ticket[field][:100].replace('\n', ' ')))
             else:
-                print field.capitalize(), ": ", ticket[field]
-        print ""
+                logger.debug("%s: %s", field.capitalize(), ticket[field])
+
+def resolveZDIds(tickets):
+    # Collects the submitter, assignee and org IDs missing from the directory across every ticket in a reply,
+    # so they can all be looked up together. Until the first sync has finished, nearly everyone is missing, so
+    # replies show raw IDs rather than looking them all up.
+    if not zd_dir.isReady():
+        return
+    user_ids = set()
+    org_ids = set()
+    for ticket in tickets:
+        for field in ("submitter_id", "assignee_id"):
+            if ticket.get(field) and ticket[field] not in zd_users:
+                user_ids.add(ticket[field])
+        if ticket.get("organization_id") and ticket["organization_id"] not in zd_orgs:
+            org_ids.add(ticket["organization_id"])
+    if user_ids or org_ids:
+        zd_dir.resolve(sorted(user_ids), sorted(org_ids), zd_resolve_budget)
 
 def respondZDData(tickets, result_limit):
-    # Function to return all Zendesk results, formatted as a single string for Slack
-
-    # Fields I care about
-    t_fields = ['id', 'subject', 'submitter_id','assignee_id', 'organization_id', 'status', 'description']
-    response = ""
-    result = 0
-
-    for ticket in tickets:
-        if result < result_limit:
-            result += 1
-            for field in t_fields:
-                if field == "id":
-                    human_url = "https://cumulusnetworks.zendesk.com/agent/tickets/"+str(ticket[field])
-                    response = response+"*ID*: <"+human_url+"|#"+str(ticket[field])+">\n"
-                elif field == "submitter_id":
-                    try:
-                        response = response + "*Submitter*: %s (%s)\n" % (str(zd_users[ticket[field]]["name"]), \
-                                                                          str(zd_users[ticket[field]]["email"]))
-
-                    except KeyError:
-                        response = response + "*Submitter*: " + str(ticket[field]) + "\n"
-                elif field == "assignee_id":
-                    try:
-                        response = response + "*Assignee*: " + str(zd_users[ticket[field]]["name"]) + "\n"
-                    except KeyError:
-                        response = response + "*Assignee*: " + str(ticket[field]) + "\n"
-                elif field == "organization_id":
-                    try:
-                        response = response + "*Organisation*: " + str(zd_orgs[ticket[field]]["name"]) + "\n"
-                    except KeyError:
-                        response = response + "*Organisation*: " + str(ticket[field]) + "\n"
-                elif field == "description":
-                    response = response + "*Description*: " + ticket[field]\
-                        [:100].replace('\n', ' ').replace("\r", "") + "\n"
-                else:
-                    response = response + "*"+str(field.capitalize())+"*" + ": " + str(ticket[field]) + "\n"
-            response = response + "\n"
-    return response
+    # Function to render Zendesk results for Slack, one ticket at a time
+
+    # Name anyone created since the last directory sync rather than showing their raw ID
+    resolveZDIds(tickets[:result_limit])
+
+    for ticket in tickets[:result_limit]:
+        yield renderZDTicket(ticket)
+
+def renderZDTicket(ticket):
+    # Template for one Zendesk ticket in a Slack reply
+    human_url = "https://cumulusnetworks.zendesk.com/agent/tickets/%s" % ticket["id"]
+    lines = ["*ID*: <%s|#%s>" % (human_url, ticket["id"]),
+             "*Subject*: %s" % ticket["subject"]]
+    try:
+        submitter = zd_users[ticket["submitter_id"]]
+        lines.append("*Submitter*: %s (%s)" % (submitter["name"], submitter["email"]))
+    except KeyError:
+        lines.append("*Submitter*: %s" % ticket["submitter_id"])
+    try:
+        lines.append("*Assignee*: %s" % zd_users[ticket["assignee_id"]]["name"])
+    except KeyError:
+        lines.append("*Assignee*: %s" % ticket["assignee_id"])
+    try:
+        lines.append("*Organisation*: %s" % zd_orgs[ticket["organization_id"]]["name"])
+    except KeyError:
+        lines.append("*Organisation*: %s" % ticket["organization_id"])
+    lines.append("*Status*: %s" % ticket["status"])
+    lines.append("*Description*: %s" % (ticket["description"] or "")[:100].replace('\n', ' ').replace("\r", ""))
+    return "\n".join(lines) + "\n\n"
+
+# Identifies this process to the other bot processes sharing its stores
+instance_id = "%s:%d" % (socket.gethostname(), os.getpid())
+
+class sqlite_store:
+    # Base for the SQLite files the bot keeps. Subclasses give a schema and its version, and a file written by
+    # another version is rebuilt from scratch. Files are in WAL mode so several bot processes on a host can share
+    # them, reading while one of them writes.
+    version = 0
+    schema = ""
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        # Set up under the write lock, so two processes starting together don't both rebuild the file
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            db.execute("PRAGMA journal_mode = WAL")
+            db.execute("BEGIN IMMEDIATE")
+            if db.execute("PRAGMA user_version").fetchone()[0] != self.version:
+                # A new file or one from another version. Start empty so the next sync downloads everything.
+                logger.info("Creating %s version %d at %s", self.__class__.__name__, self.version, self.path)
+                tables = db.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")
+                for table in tables.fetchall():
+                    db.execute("DROP TABLE %s" % table)
+                for statement in self.schema.split(";"):
+                    if statement.strip():
+                        db.execute(statement)
+                db.execute("PRAGMA user_version = %d" % self.version)
+            db.execute("CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT, expires REAL)")
+            db.execute("COMMIT")
+        finally:
+            db.close()
+
+    def db(self):
+        # sqlite3 connections can't be shared between threads, so each thread opens its own
+        if not hasattr(self.local, "db"):
+            self.local.db = sqlite3.connect(self.path, timeout=30)
+            self.local.db.execute("PRAGMA synchronous = NORMAL")
+        return self.local.db
+
+    def lease(self, name, ttl):
+        # Takes or renews the named lease for ttl seconds. Returns True while this process holds it, so of the
+        # processes sharing the file only one does the work it guards. Another takes over if it stops renewing.
+        db = self.db()
+        now = time()
+        with db:
+            db.execute("INSERT OR IGNORE INTO leases (name, owner, expires) VALUES (?, ?, 0)", (name, instance_id))
+            held = db.execute("UPDATE leases SET owner = ?, expires = ? WHERE name = ? AND (owner = ? OR expires < ?)",
+                              (instance_id, now + ttl, name, instance_id, now)).rowcount
+        return held == 1
+
+class zd_store(sqlite_store):
+    # On-disk Zendesk directory, holding only the fields replies use. Rows are indexed by ID and read on demand,
+    # so startup doesn't load anything and memory stays flat however many users Zendesk has.
+    version = 1
+    schema = """
+        CREATE TABLE users (id INTEGER PRIMARY KEY, name TEXT, email TEXT);
+        CREATE TABLE orgs (id INTEGER PRIMARY KEY, name TEXT);
+        CREATE TABLE hwm (r_type TEXT PRIMARY KEY, end_time INTEGER);
+    """
+
+    def hwm(self, r_type):
+        row = self.db().execute("SELECT end_time FROM hwm WHERE r_type = ?", (r_type,)).fetchone()
+        return row[0] if row else 0
+
+    def update(self, users, orgs, hwm):
+        # Applies a sync's changed rows and new high-water marks in one transaction
+        db = self.db()
+        with db:
+            db.executemany("INSERT OR REPLACE INTO users (id, name, email) VALUES (?, ?, ?)", users)
+            db.executemany("INSERT OR REPLACE INTO orgs (id, name) VALUES (?, ?)", orgs)
+            db.executemany("INSERT OR REPLACE INTO hwm (r_type, end_time) VALUES (?, ?)", hwm.items())
+
+    def stage(self, users, orgs):
+        # Sets a page of a sync's changed rows aside until finish(). They go into TEMP tables, on disk and seen
+        # only by this thread's connection, so the sync's memory stays flat and no one else waits on it.
+        db = self.db()
+        db.execute("CREATE TEMP TABLE IF NOT EXISTS staged_users (id INTEGER PRIMARY KEY, name TEXT, email TEXT)")
+        db.execute("CREATE TEMP TABLE IF NOT EXISTS staged_orgs (id INTEGER PRIMARY KEY, name TEXT)")
+        with db:
+            db.executemany("INSERT OR REPLACE INTO staged_users (id, name, email) VALUES (?, ?, ?)", users)
+            db.executemany("INSERT OR REPLACE INTO staged_orgs (id, name) VALUES (?, ?)", orgs)
+
+    def finish(self, hwm):
+        # Applies every staged row and the new high-water marks in one transaction. Returns how many users and
+        # orgs changed.
+        db = self.db()
+        self.stage([], [])
+        with db:
+            users = db.execute("INSERT OR REPLACE INTO users SELECT id, name, email FROM staged_users").rowcount
+            orgs = db.execute("INSERT OR REPLACE INTO orgs SELECT id, name FROM staged_orgs").rowcount
+            db.executemany("INSERT OR REPLACE INTO hwm (r_type, end_time) VALUES (?, ?)", hwm.items())
+        self.discard()
+        return users, orgs
+
+    def discard(self):
+        # Drops whatever a sync staged, e.g. when it fails part way and will start again from the old marks
+        db = self.db()
+        db.execute("DROP TABLE IF EXISTS temp.staged_users")
+        db.execute("DROP TABLE IF EXISTS temp.staged_orgs")
+
+    def clear(self):
+        db = self.db()
+        with db:
+            for table in ("users", "orgs", "hwm"):
+                db.execute("DELETE FROM %s" % table)
+
+class zd_table:
+    # Read-only, dict-like view of one directory table, e.g. zd_users[id]["name"]. Raises KeyError for unknown
+    # IDs, just like the dicts it replaced.
+    def __init__(self, store, table, columns):
+        self.store = store
+        self.columns = columns
+        self.select = "SELECT %s FROM %s WHERE id = ?" % (", ".join(columns), table)
+        self.count = "SELECT COUNT(*) FROM %s" % table
+
+    def __getitem__(self, id):
+        row = self.store.db().execute(self.select, (id,)).fetchone()
+        if row is None:
+            raise KeyError(id)
+        return dict(zip(self.columns, row))
+
+    def __contains__(self, id):
+        return self.store.db().execute(self.select, (id,)).fetchone() is not None
+
+    def __len__(self):
+        return self.store.db().execute(self.count).fetchone()[0]
+
+class zd_directory:
+    # Keeps the Zendesk user and organisation directory used to name ticket submitters, assignees and orgs.
+    # Syncs use Zendesk's incremental export API, so only users and orgs changed since the last sync's
+    # high-water mark are downloaded. The first sync (high-water mark 0) downloads everything. Of the bot
+    # processes sharing a store, only the one holding the sync lease downloads.
+    lease_ttl = 600
+    # How long, and for how many IDs, lookups that found nothing are remembered
+    missing_ttl = 3600
+    missing_size = 10000
+
+    def __init__(self, client, store):
+        self.client = client
+        self.store = store
+        self.lock = threading.Lock()
+        # (type, ID) -> time until which an ID Zendesk didn't return (e.g. a deleted user) isn't asked for again,
+        # soonest to expire first
+        self.missing = collections.OrderedDict()
+        self.missing_lock = threading.Lock()
+        # Set once the whole directory has been downloaded, which a directory kept from an earlier run already has
+        self.ready = threading.Event()
+        if store.hwm("users"):
+            self.ready.set()
+
+    def changes(self, r_type, stage):
+        # Pulls everything of r_type changed since the high-water mark, staging it a page at a time.
+        # Returns the new high-water mark.
+        hwm = self.store.hwm(r_type)
+        for entries, hwm in getZDIncremental(self.client, r_type, hwm):
+            stage(entries)
+            # A full download can take a while. Keep the lease so no one else starts one.
+            self.store.lease("directory-sync", self.lease_ttl)
+        return hwm
+
+    def isReady(self):
+        # Another process may have finished the download since we last looked
+        if not self.ready.is_set() and self.store.hwm("users"):
+            self.ready.set()
+            logger.info("Zendesk directory ready")
+        return self.ready.is_set()
+
+    def sync(self):
+        # Brings the directory up to date. Nothing changes in the store until both downloads have finished.
+        if not self.store.lease("directory-sync", self.lease_ttl):
+            # Another process is syncing the shared store
+            self.isReady()
+            return
+        with self.lock:
+            self.store.discard()
+            users_hwm = self.changes("users", lambda users: self.store.stage(
+                [(user["id"], user["name"], user["email"]) for user in users], []))
+            orgs_hwm = self.changes("organizations", lambda orgs: self.store.stage(
+                [], [(org["id"], org["name"]) for org in orgs]))
+            users, orgs = self.store.finish({"users": users_hwm, "organizations": orgs_hwm})
+            logger.info("Zendesk directory sync: %d users and %d orgs changed", users, orgs)
+            if not self.ready.is_set():
+                self.ready.set()
+                logger.info("Zendesk directory ready")
+
+    def resolve(self, user_ids, org_ids, budget):
+        # Looks up users and orgs missing from the store with one show_many call per type, giving up on whatever
+        # is left once the budget (in seconds) runs out. What is found is stored for later replies too.
+        deadline = time() + budget
+        found = {"users": [], "organizations": []}
+        for r_type, ids, row in (("users", user_ids, lambda user: (user["id"], user["name"], user["email"])),
+                                 ("organizations", org_ids, lambda org: (org["id"], org["name"]))):
+            # show_many takes up to 100 IDs
+            ids = [id for id in ids if self.missing.get((r_type, id), 0) < time()][:100]
+            remaining = deadline - time()
+            if not ids or remaining <= 0:
+                continue
+            url = self.client.url(r_type + "/show_many", {"ids": ",".join(str(id) for id in ids)})
+            try:
+                entries = self.client.get(url, timeout=remaining, retries=0)[r_type]
+            except ZendeskError as e:
+                logger.warning("Unable to look up Zendesk %s %s: %s", r_type, truncated(ids), e)
+                continue
+            found[r_type] = [row(entry) for entry in entries]
+            with self.missing_lock:
+                for id in set(ids) - set(entry["id"] for entry in entries):
+                    self.missing.pop((r_type, id), None)
+                    self.missing[(r_type, id)] = time() + self.missing_ttl
+                # Every entry lives as long, so the expired ones are at the front. Past the cap, the oldest go
+                # early and are just asked for again.
+                while self.missing and (next(self.missing.itervalues()) < time()
+                                        or len(self.missing) > self.missing_size):
+                    self.missing.popitem(last=False)
+        if found["users"] or found["organizations"]:
+            self.store.update(found["users"], found["organizations"], {})
+
+    def start(self, interval):
+        # Syncs straight away, then keeps syncing while the bot runs, all in the background
+        self.lease_ttl = max(interval * 3, self.lease_ttl)
+        repeat(interval, self.sync, "directory-sync", delay=0)
+
+# JIRA fields the replies render. Searches ask JIRA for these and nothing else.
+jr_fields = ['summary', 'status', 'reporter', 'assignee', 'customfield_10602', 'description']
 
 def connectToJira(options):
     # Use JIRA API to establish an authenticated session.
-    jira = JIRA(server=options['server'], basic_auth=(options['username'], options['password']))
+    jira = JIRA(server=options['server'], basic_auth=(options['username'], options['password']),
+                timeout=options['timeout'], max_retries=options['retries'])
+    observeResponses(jira._session, "jira")
     return jira
 
-def getJiraTickets(jira, search_str, text_only):
-    # Uses JIRA API to search for tickets matching the JQL language query string. Returns a list of JIRA Issue objects.
+class jira_session(object):
+    # A JIRA connection shared by every worker. Stands in for the JIRA object, logging in on first use and
+    # again only when JIRA says the session has expired.
+    def __init__(self, options):
+        self.options = options
+        self.lock = threading.Lock()
+        self.jira = None
+
+    def connect(self, stale):
+        # Replaces the connection, unless another worker already replaced the stale one
+        with self.lock:
+            if self.jira is stale:
+                logger.info("Connecting to JIRA at %s", self.options['server'])
+                self.jira = connectToJira(self.options)
+            return self.jira
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            jira = self.jira or self.connect(None)
+            try:
+                return self.timed(jira, name, args, kwargs)
+            except JIRAError as e:
+                if e.status_code != 401:
+                    raise
+                logger.info("JIRA session expired.")
+                metrics.count("rocketsearch_upstream_retries_total", provider="jira", call=name)
+            return self.timed(self.connect(jira), name, args, kwargs)
+        return call
+
+    def timed(self, jira, name, args, kwargs):
+        status = "error"
+        outbound.acquire("jira")
+        try:
+            with metrics.timed("upstream", provider="jira", call=name):
+                result = getattr(jira, name)(*args, **kwargs)
+            status = "ok"
+            return result
+        except JIRAError as e:
+            status = e.status_code or "error"
+            raise
+        finally:
+            metrics.count("rocketsearch_upstream_requests_total", provider="jira", call=name, status=status)
+
+def getJiraTickets(jira, search_str, text_only, limit):
+    # Uses JIRA API to search for tickets matching the JQL language query string. Returns a list of up to limit
+    # issue records, fetched with the fields we reply with in the same call.
     if text_only:
         # Searches based on text only. Shortcuts full JQL.
-        tickets = jira.search_issues("text ~ '%s'" % search_str)
-    else:
-        # Must be a full JQL query.
-        tickets = jira.search_issues(search_str)
-    return tickets
+        search_str = "text ~ '%s'" % search_str
+    # Otherwise it must be a full JQL query.
+    return continueJiraTickets(jira, {"jql": search_str, "start": 0}, limit)
+
+def continueJiraTickets(jira, cursor, limit):
+    # Fetches up to limit issue records from where a cursor got to. Returns them and a cursor for the rest, or
+    # None if there are no more.
+    if limit <= 0:
+        # python-jira reads maxResults=0 as "every page", so ask for nothing instead, as Zendesk does
+        return [[], cursor]
+    tickets = jira.search_issues(cursor["jql"], startAt=cursor["start"], maxResults=limit,
+                                 fields=",".join(jr_fields))
+    start = cursor["start"] + len(tickets)
+    rest = {"jql": cursor["jql"], "start": start} if tickets and start < tickets.total else None
+    return [[jiraRecord(ticket) for ticket in tickets], rest]
+
+def getJiraIssuesByKey(jira, keys):
+    # Reads issues by key with one search, through the record cache. Returns their records in the order asked
+    # for, leaving out any that don't exist.
+    def fetch(missing):
+        # Without validation, keys that don't exist are skipped instead of failing the search
+        issues = jira.search_issues("key in (%s)" % ", ".join(missing), maxResults=len(missing),
+                                    fields=",".join(jr_fields), validate_query=False)
+        return dict((issue.key, jiraRecord(issue)) for issue in issues)
+    found = record_lookups.get("jira", keys, lambda missing: upstreams["jira"].call(lambda: fetch(missing)))
+    return [found[key] for key in keys if key in found]
+
+def jiraRecord(issue):
+    # Keeps the key and the text of each field replies show, as the objects the JIRA library returns can't be
+    # stored or shared with other processes
+    fields = vars(issue.fields)
+    record = {"key": issue.key, "fields": {}}
+    for field in jr_fields:
+        if fields.get(field) is not None:
+            record["fields"][field] = unicode(fields[field])
+    if "description" in record["fields"]:
+        record["fields"]["description"] = record["fields"]["description"][:100]
+    return record
 
 class jira_bug:
-    # Takes an JIRA ticket ID and generates a dict of fields
-    def __init__(self, id):
+    # Takes a JIRA issue key and its dict of fields, from a search or the local index
+    def __init__(self, id, fields):
         self.id = id
-        self.jiraObj = jira.issue(self.id)
-        self.fields = vars(self.jiraObj.fields)
+        self.fields = fields
 
     def printBugDetails(self):
-        # Function to print all JIRA field results and format them for console
-        jr_fields = ['summary', 'status', 'reporter', 'assignee', 'customfield_10602',
-                     'description']
-        print self.fields
-        print "ID : ", self.id
+        # Function to log all JIRA field results, formatted as for the console, when debugging
+        logger.debug("Fields of %s: %s", self.id, truncated(self.fields))
         for field in jr_fields:
             try:
                 if field == "customfield_10602":
                     self.sprint = re.search(r'Release\s\d.\d.\d+', str(self.fields[field])).group()
-                    print "Sprint : %s" % self.sprint
+                    logger.debug("Sprint : %s", self.sprint)
                 elif field == "description":
-                    print  "%s : %s" % (field.capitalize(), self.fields[field][:100])
+                    logger.debug("%s : %s", field.capitalize(), self.fields[field][:100])
                 else:
-                    print  "%s : %s" % (field.capitalize(), self.fields[field])
+                    logger.debug("%s : %s", field.capitalize(), truncated(self.fields[field]))
             except (AttributeError, TypeError, KeyError) as e:
                 if KeyError:
-                    print "No key %s for bug %s." % (field, self.id)
+                    logger.debug("No key %s for bug %s.", field, self.id)
                 elif (AttributeError or TypeError) and "NoneType" in str(e):
-                    print str(e)
+                    logger.debug("%s", e)
                 else:
                     raise
 
-        print("\n")
-
     def respondBugDetails(self):
         # Function to return all JIRA fields, formatted as a single string for Slack
-        jr_fields = ['summary', 'status', 'reporter', 'assignee', 'customfield_10602',
-                     'description']
-        response = "*ID*: <https://tickets.cumulusnetworks.com/browse/%s|%s>\n" % (self.id, self.id)
+        response = ["*ID*: <https://tickets.cumulusnetworks.com/browse/%s|%s>\n" % (self.id, self.id)]
         for field in jr_fields:
             try:
                 if field == "customfield_10602":
                     self.sprint = re.search(r'Release\s\d.\d.\d+', str(self.fields[field])).group()
-                    response += "*Sprint*: %s\n" % self.sprint
+                    response.append("*Sprint*: %s\n" % self.sprint)
                 elif field == "description":
-                    response += "*%s*: %s\n" % (field.capitalize(),
-                                                self.fields[field][:100].replace('\n', ' ').replace("\r", ""))
+                    response.append("*%s*: %s\n" % (field.capitalize(),
+                                                    self.fields[field][:100].replace('\n', ' ').replace("\r", "")))
                 else:
-                    response = response + "*%s*: %s\n" % (field.capitalize(), self.fields[field])
+                    response.append("*%s*: %s\n" % (field.capitalize(), self.fields[field]))
             except (AttributeError, TypeError, KeyError) as e:
                 if ("NoneType" in str(e)) or KeyError:
                     # Hit here if field does not exist or value None
@@ -185,8 +632,215 @@ class jira_bug:
                 else:
                     raise
 
-        response = response + "\n"
-        return response
+        response.append("\n")
+        return "".join(response)
+
+# Words as the local index sees them
+word_re = re.compile(r'\w+', re.UNICODE)
+
+def tokenize(text):
+    return word_re.findall(text.lower())
+
+# Queries using search operators or quoting need the providers' own search engines
+operator_re = re.compile(r'[:=~<>"\'*()]|\b(AND|OR|NOT)\b|(^|\s)[-+]\w')
+
+def isPlainText(query):
+    # True if the query is just words, which the local index can answer
+    return not operator_re.search(query)
+
+def jiraTime(stamp):
+    # Seconds since the epoch for a JIRA date, e.g. 2016-05-10T12:34:56.000+1000
+    offset = (int(stamp[-4:-2]) * 3600 + int(stamp[-2:]) * 60) * (-1 if stamp[-5] == "-" else 1)
+    return calendar.timegm(datetime.datetime.strptime(stamp[:19], "%Y-%m-%dT%H:%M:%S").timetuple()) - offset
+
+class search_index(sqlite_store):
+    # Optional local full-text index over Zendesk ticket subjects/descriptions and JIRA issue
+    # summaries/descriptions, ranked with BM25. Background syncs add whatever changed since the last one, and
+    # each matching document carries the record replies are rendered from. Of the bot processes sharing an
+    # index, only the one holding the sync lease syncs it.
+    version = 2
+    lease_ttl = 600
+    schema = """
+        CREATE TABLE docs (id INTEGER PRIMARY KEY, source TEXT, key TEXT, length INTEGER, record TEXT,
+                           UNIQUE (source, key));
+        CREATE TABLE postings (term TEXT, source TEXT, doc INTEGER, tf INTEGER);
+        CREATE INDEX postings_term ON postings (term, source);
+        CREATE INDEX postings_doc ON postings (doc);
+        CREATE TABLE marks (source TEXT PRIMARY KEY, mark TEXT);
+    """
+    # BM25 term frequency saturation and document length normalisation
+    k1 = 1.2
+    b = 0.75
+
+    def __init__(self, path, zd_client, jira, jql, max_postings):
+        sqlite_store.__init__(self, path)
+        self.zd_client = zd_client
+        self.jira = jira
+        self.jql = jql
+        self.max_postings = max_postings
+        self.lock = threading.Lock()
+        # Sources whose first build has finished, here or in another process
+        self.built = set()
+
+    def mark(self, source):
+        row = self.db().execute("SELECT mark FROM marks WHERE source = ?", (source,)).fetchone()
+        return row[0] if row else None
+
+    def isBuilt(self, source):
+        # The first build is written page by page, oldest first, so until a sync has read everything from
+        # source the newest matches would be missing. Searches go to the provider until then.
+        if source not in self.built and self.mark(source + ":built"):
+            self.built.add(source)
+        return source in self.built
+
+    def finish(self, source):
+        # Called once a sync has read everything from source
+        if not self.isBuilt(source):
+            db = self.db()
+            with db:
+                db.execute("INSERT OR REPLACE INTO marks (source, mark) VALUES (?, ?)",
+                           (source + ":built", str(time())))
+            self.built.add(source)
+            logger.info("Local index of %s built", source)
+
+    def size(self, source):
+        # Returns the number of documents indexed from source and their total length in words
+        count, length = self.db().execute("SELECT COUNT(*), SUM(length) FROM docs WHERE source = ?",
+                                          (source,)).fetchone()
+        return count, length or 0
+
+    def update(self, source, docs, deleted, mark):
+        # Replaces the changed documents, given as (key, text, record), drops the deleted keys and records how far
+        # the sync got, all in one transaction
+        db = self.db()
+        with db:
+            for key in deleted + [doc[0] for doc in docs]:
+                row = db.execute("SELECT id FROM docs WHERE source = ? AND key = ?", (source, key)).fetchone()
+                if row:
+                    db.execute("DELETE FROM postings WHERE doc = ?", row)
+                    db.execute("DELETE FROM docs WHERE id = ?", row)
+            for key, text, record in docs:
+                terms = collections.Counter(tokenize(text))
+                doc = db.execute("INSERT INTO docs (source, key, length, record) VALUES (?, ?, ?, ?)",
+                                 (source, key, sum(terms.values()), json.dumps(record))).lastrowid
+                db.executemany("INSERT INTO postings (term, source, doc, tf) VALUES (?, ?, ?, ?)",
+                               [(term, source, doc, tf) for term, tf in terms.items()])
+            db.execute("INSERT OR REPLACE INTO marks (source, mark) VALUES (?, ?)", (source, mark))
+
+    def search(self, source, query, limit):
+        # Returns the records of the best limit documents from source containing every word of the query, or
+        # None if source hasn't been fully indexed yet or every word is too common to rank here
+        if not self.isBuilt(source):
+            return None
+        count, length = self.size(source)
+        if not count:
+            return []
+        average = float(length) / count
+        db = self.db()
+        # Number of documents each word is in, read from the postings index without loading the postings
+        frequencies = dict((term, db.execute("SELECT COUNT(*) FROM postings WHERE term = ? AND source = ?",
+                                             (term, source)).fetchone()[0]) for term in set(tokenize(query)))
+        if not frequencies or not min(frequencies.values()):
+            # Multiple words are ANDed, as they are by the providers, so one word nowhere means no matches
+            return []
+        terms = sorted(frequencies, key=frequencies.get)
+        if frequencies[terms[0]] > self.max_postings:
+            logger.debug("Every word of %s is in over %d %s documents", query, self.max_postings, source)
+            return None
+        # Only the rarest word's postings are read in full. Those documents are the only ones that can match, so
+        # the other words' postings are only read for them.
+        postings = {terms[0]: dict(db.execute("SELECT doc, tf FROM postings WHERE term = ? AND source = ?",
+                                              (terms[0], source)).fetchall())}
+        docs = list(postings[terms[0]])
+        for term in terms[1:]:
+            postings[term] = {}
+            for i in range(0, len(docs), 500):
+                batch = docs[i:i + 500]
+                postings[term].update(db.execute("SELECT doc, tf FROM postings WHERE term = ? AND source = ? AND "
+                                                 "doc IN (%s)" % ",".join("?" * len(batch)),
+                                                 [term, source] + batch).fetchall())
+            docs = [doc for doc in docs if doc in postings[term]]
+            if not docs:
+                return []
+        lengths = {}
+        for i in range(0, len(docs), 500):
+            batch = docs[i:i + 500]
+            lengths.update(db.execute("SELECT id, length FROM docs WHERE id IN (%s)" % ",".join("?" * len(batch)),
+                                      batch).fetchall())
+        scores = collections.defaultdict(float)
+        for term in terms:
+            idf = math.log(1 + (count - frequencies[term] + 0.5) / (frequencies[term] + 0.5))
+            for doc in docs:
+                tf = postings[term][doc]
+                scores[doc] += idf * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * lengths[doc] / average))
+        best = heapq.nlargest(limit, scores, key=scores.get)
+        records = dict(db.execute("SELECT id, record FROM docs WHERE id IN (%s)" % ",".join("?" * len(best)),
+                                  best).fetchall()) if best else {}
+        return [json.loads(records[doc]) for doc in best]
+
+    def syncZendesk(self):
+        # Indexes tickets changed since the last sync using the incremental ticket export
+        for tickets, end_time in getZDIncremental(self.zd_client, "tickets", int(self.mark("zendesk") or 0)):
+            docs = []
+            deleted = []
+            for ticket in tickets:
+                if ticket["status"] == "deleted":
+                    deleted.append(str(ticket["id"]))
+                    continue
+                record = dict((field, ticket.get(field)) for field in
+                              ('id', 'subject', 'submitter_id', 'assignee_id', 'organization_id', 'status'))
+                record["description"] = (ticket.get("description") or "")[:100]
+                docs.append((str(ticket["id"]), "%s %s" % (ticket.get("subject") or "", ticket.get("description") or ""),
+                             record))
+            self.update("zendesk", docs, deleted, str(end_time))
+            logger.info("Indexed %d Zendesk tickets", len(docs))
+            # A first build can take a while. Keep the lease so no one else starts one.
+            self.lease("index-sync", self.lease_ttl)
+        self.finish("zendesk")
+
+    def syncJira(self):
+        # Indexes issues updated since the last sync. The mark is when the newest one was updated, in seconds since
+        # the epoch. JQL reads dates in the searching user's time zone, which we don't know, so the search asks for
+        # issues updated in the last however many minutes instead. It goes back a couple of minutes more in case
+        # the clocks are apart, and the issues fetched again are simply replaced.
+        mark = self.mark("jira")
+        jql = self.jql
+        if mark:
+            since = 'updated >= "-%dm"' % ((time() - float(mark)) // 60 + 2)
+            jql = ("(%s) AND %s" % (jql, since)) if jql else since
+        jql += " ORDER BY updated ASC"
+        start = 0
+        while True:
+            issues = self.jira.search_issues(jql, startAt=start, maxResults=100,
+                                             fields=",".join(jr_fields + ["updated"]))
+            docs = []
+            for issue in issues:
+                fields = vars(issue.fields)
+                docs.append((issue.key, "%s %s" % (fields.get("summary") or "", fields.get("description") or ""),
+                             jiraRecord(issue)))
+                mark = str(jiraTime(fields["updated"]))
+            self.update("jira", docs, [], mark)
+            logger.info("Indexed %d JIRA issues", len(docs))
+            self.lease("index-sync", self.lease_ttl)
+            start += len(issues)
+            if not issues or start >= issues.total:
+                break
+        self.finish("jira")
+
+    def sync(self):
+        if not self.lease("index-sync", self.lease_ttl):
+            return
+        with self.lock:
+            for name, sync in (("Zendesk", self.syncZendesk), ("JIRA", self.syncJira)):
+                try:
+                    sync()
+                except Exception as e:
+                    logger.warning("Unable to index %s: %s", name, e)
+
+    def start(self, interval):
+        # Builds or catches up the index straight away, then keeps syncing in the background while the bot runs
+        self.lease_ttl = max(interval * 3, self.lease_ttl)
+        repeat(interval, self.sync, "index-sync", delay=0)
 
 class slack:
     # Creates objects for incoming messages
@@ -194,7 +848,13 @@ class slack:
         self.message = message
         self.text = self.message["text"]
         self.channel = self.message["channel"]
+        # Set for messages in a thread. Searches in different threads of a channel are continued separately.
+        self.thread = self.message.get("thread_ts")
         self.user = self.message["user"]
+        # When it came off the RTM socket, for timing how long it waits for a worker
+        self.received = time()
+        # Stages timed while handling it, when tracing
+        self.trace = None
         # Check for ourselves so we don't respond to our own messages
         self.isBot = False
         if slackBot == str(self.user):
@@ -207,319 +867,1508 @@ class slack:
         self.isPublic = False
 
         if re.match(r'D', str(self.channel)):
-            print "DM True"
             self.isDM = True
         elif re.match(r'G', str(self.channel)):
-            print "Private True"
             self.isPrivate = True
         elif re.match(r'C', str(self.channel)):
-            print "Public True"
             self.isPublic = True
         else:
-            print "Unknown channel type"
+            logger.debug("Unknown channel type for %s", self.channel)
 
     def checkInvoked(self):
         # Function to see if the bot was "invoked"
         # That changes based on channel type
         self.getChannelType()
-        print "made it past channel selection"
-        # Once we have the channel type, use regex to see if the bot was "invoked"
-        self.search = search(self)
+        # Once we have the channel type, parse the message to see if the bot was "invoked"
+        with metrics.timed("parse"):
+            self.search = message_router.parse(self.text, self.isDM)
         if self.search.invoked:
             return True
 
     def response(self, string):
         # Pushes the bot's response to Slack postMessage API
-        print "Response to channel %s is: \n%s" % (self.channel, string.encode("ascii", "ignore"))
-        rocketsearch.api_call("chat.postMessage", channel=self.channel, text=string, as_user=True, unfurl_links=False)
+        logger.debug("Response to channel %s is: %s", self.channel, truncated(string), extra={"sample": "response"})
+        # Slack allows about one post a second per channel. Posts over the limit wait their turn, and posts
+        # Slack rejects as rate limited are tried again once it says they can be.
+        destination = "slack:%s" % self.channel
+        # Messages in a thread are answered in the thread
+        options = {"thread_ts": self.thread} if self.thread else {}
+        for attempt in range(3):
+            outbound.acquire(destination)
+            with metrics.timed("upstream", provider="slack", call="chat.postMessage"):
+                result = rocketsearch.api_call("chat.postMessage", channel=self.channel, text=string, as_user=True,
+                                               unfurl_links=False, **options)
+            metrics.count("rocketsearch_upstream_requests_total", provider="slack", call="chat.postMessage",
+                          status="ok" if result.get("ok") else result.get("error", "error"))
+            if result.get("error") != "ratelimited":
+                break
+            outbound.observe(destination, 429, result.get("headers"))
 
 class search:
-    # Determines and assigns search parameters to the Slack messages. Determine whether bot was invoked.
-    def __init__(self, slackObj):
-        self.invoked = True
-        self.zd = False
-        self.jira = False
-        self.sfdc = False
+    # A parsed message: whether the bot was invoked, which providers to search, the query, the result limit and
+    # any options. Built by router.parse().
+    def __init__(self, isDM):
+        self.isDM = isDM
+        self.invoked = False
+        self.providers = ()
         self.textonly = False
         self.help = False
-
-        # If it's a direct message to the bot
-        if slackObj.isDM and re.search(r'zendesk', slackObj.text, re.I):
-            print "DM zendesk: " + slackObj.text.encode("ascii", "ignore")
-            self.zd = True
-        elif slackObj.isDM and re.search(r'jira', slackObj.text, re.I):
-            print "DM jira: " + slackObj.text.encode("ascii", "ignore")
-            self.jira = True
-        elif slackObj.isDM and re.search(r'sf|salesforce', slackObj.text, re.I):
-            print "DM sfdc: " + slackObj.text.encode("ascii", "ignore")
-            self.sfdc = True
-        elif slackObj.isDM and re.search(r'text', slackObj.text, re.I):
-            print "DM text: " + slackObj.text.encode("ascii", "ignore")
-            self.textonly = True
-            self.zd = True
-            self.jira = True
-        elif slackObj.isDM and re.search(r'help', slackObj.text, re.I):
-            print "DM help: " + slackObj.text.encode("ascii", "ignore")
-            self.help = True
-
-        # If we're tagged in a channel with "@<BOT>" at the start of a line
-        elif re.search(r'^(<@%s.*?zendesk)' % slackBot, slackObj.text, re.I):
-            print "Channel zendesk: " + slackObj.text.encode("ascii", "ignore")
-            self.zd = True
-        elif re.search(r'^(<@%s.*?jira)' % slackBot, slackObj.text, re.I):
-            print "Channel jira: " + slackObj.text.encode("ascii", "ignore")
-            self.jira = True
-        elif re.search(r'^(<@%s.*? sf|salesforce)' % slackBot, slackObj.text, re.I):
-            print "Channel sfdc: " + slackObj.text.encode("ascii", "ignore")
-            self.sfdc = True
-        elif re.search(r'^(<@%s.*?text)' % slackBot, slackObj.text, re.I):
-            print "Channel text: " + slackObj.text.encode("ascii", "ignore")
-            self.textonly = True
-            self.zd = True
-            self.jira = True
-        elif re.search(r'^(<@%s.*?help)' % slackBot, slackObj.text, re.I):
-            print "Channel help: " + slackObj.text.encode("ascii", "ignore")
-            self.help = True
-        else:
-            self.invoked = False
-            print "I was not invoked or source was selected"
-
-    def getSearchParams(self, slackObj):
-        # Gets the search parameters from within the quotations of a Slack message.
-        print "Searching..."
-        _regex = ur'((\"|\u201c)(.*?)\")'
-        _regexc = re.compile(_regex, re.UNICODE)
-        self.string = re.search(_regexc, slackObj.text)
-        if self.string and (self.jira or self.zd or self.sfdc):
-            self.string = self.string.group(3)
-            return True
-        else:
-            return False
-
-    def getLimit(self, slackObj):
-        # Checks for a reply limit being specified in the Slack message.
-        self.result_limit = re.search(r'limit=(\d+|none)', slackObj.text, re.I)
-        if self.result_limit:
-            print "Found a result limit of %s" % self.result_limit.group(1)
-            self.result_limit = self.result_limit.group(1)
-            try:
-                # Check if the limit was an integer.
-                self.result_limit = int(self.result_limit)
-            except ValueError:
-                # Therefore must be "none" so set it to a stupidly large number
-                self.result_limit = 999999
-            print "Using a result limit of %s of type %s" % (self.result_limit, type(self.result_limit))
+        self.live = False
+        # Asking for the next results of the last search in the channel or thread
+        self.more = False
+        self.string = None
+        # Ticket numbers or issue keys, when the query only names those
+        self.ids = None
+        self.result_limit = None
+
+class router:
+    # Reads a message into a search object in a single pass of one regex, compiled once from the registered
+    # keywords. Commands (the providers and help) and options are registered by keyword, so adding one doesn't
+    # add another pattern to try against every message.
+    pattern = ur"""
+        [\"\u201c](?P<query>.*?)[\"\u201d]    # the query, in straight or curly quotes
+        | limit=(?P<limit>\d+|none)\b           # a result limit
+        | \b(?P<word>%s)\b                      # a registered keyword. Other words are skipped by the regex.
+        """
+
+    def __init__(self, bot_id, default_limit):
+        self.bot_id = bot_id
+        # In a channel we must be tagged at the start of the message
+        self.tag = u"<@%s" % bot_id
+        self.default_limit = default_limit
+        self.commands = {}
+        self.options = {}
+        self.token_re = None
+
+    def command(self, keywords, leading=False, **attributes):
+        # Registers a command. When a message has several command keywords outside the quotes, the one registered
+        # first wins, whatever order they come in. A leading command only counts at the start of a message.
+        for keyword in keywords:
+            self.commands[keyword.lower()] = (len(self.commands), leading, attributes)
+        self.token_re = None
+
+    def option(self, keyword, **attributes):
+        # Registers an option, which can be added to any command
+        self.options[keyword.lower()] = attributes
+        self.token_re = None
+
+    def compile(self):
+        # Longest keywords first, so one that starts with another still matches in full
+        keywords = sorted(self.commands.keys() + self.options.keys(), key=len, reverse=True)
+        self.token_re = re.compile(self.pattern % "|".join(re.escape(keyword) for keyword in keywords),
+                                   re.I | re.U | re.X)
+        return self.token_re
+
+    def parse(self, text, isDM):
+        parsed = search(isDM)
+        if parsed.isDM:
+            start = 0
+        elif text.startswith(self.tag) and text[len(self.tag):len(self.tag) + 1] in (u">", u"|"):
+            start = text.index(u">") + 1
         else:
-            print "Using default result limit of %s" % result_limit
-            self.result_limit = result_limit
+            # Channel chatter that doesn't tag us is never a command
+            parsed.result_limit = self.default_limit
+            return parsed
+        command = None
+        first = re.compile(r'\s*').match(text, start).end()
+        for token in (self.token_re or self.compile()).finditer(text, start):
+            if token.group("query") is not None:
+                if parsed.string is None:
+                    parsed.string = token.group("query")
+            elif token.group("limit"):
+                # "none" is set to a stupidly large number
+                limit = token.group("limit").lower()
+                parsed.result_limit = 999999 if limit == "none" else int(limit)
+            else:
+                word = token.group("word").lower()
+                if word in self.commands:
+                    order, leading, attributes = self.commands[word]
+                    if (not leading or token.start() == first) and (command is None or order < command[0]):
+                        command = (order, attributes)
+                elif word in self.options:
+                    vars(parsed).update(self.options[word])
+        if command is not None:
+            vars(parsed).update(command[1])
+            parsed.invoked = True
+            if parsed.string and len(parsed.providers) == 1 and not parsed.textonly:
+                parsed.ids = directIds(parsed.providers[0], parsed.string)
+        if parsed.result_limit is None:
+            parsed.result_limit = self.default_limit
+        return parsed
+
+# Queries that only name JIRA issues, e.g. "FR-137", "id = FR-137", "key in (CM-1, CM-2)" or "CM-1, CM-2"
+jira_keys_re = re.compile(r'^\s*(?:(?:id|key|issue|issuekey)\s*(?:=|in)\s*)?\(?\s*'
+                          r'([A-Z][A-Z0-9_]*-\d+(?:\s*(?:,|\s|\bor\b)\s*[A-Z][A-Z0-9_]*-\d+)*)\s*\)?\s*$', re.I)
+jira_key_re = re.compile(r'[A-Z][A-Z0-9_]*-\d+', re.I)
+# Queries that only name Zendesk tickets, e.g. "#45678" or "#45678, #45679". Bare numbers, e.g. "2016", are
+# searched for, as they are as likely to be years, model numbers or error codes.
+ticket_ids_re = re.compile(r'^\s*#\d+(?:\s*(?:,|\s)\s*#\d+)*\s*$')
+
+def directIds(provider, query):
+    # Returns the tickets or issues a query names, if that's all it does, or None if it has to be searched for.
+    # Lookups are batched, up to 100 at a time.
+    if provider == "jira":
+        match = jira_keys_re.match(query)
+        if match:
+            return uniqueIds(key.upper() for key in jira_key_re.findall(match.group(1)))
+    elif provider == "zendesk" and ticket_ids_re.match(query):
+        return uniqueIds(int(id) for id in re.findall(r'\d+', query))
+    return None
+
+def uniqueIds(ids):
+    seen = set()
+    unique = []
+    for id in ids:
+        if id not in seen:
+            seen.add(id)
+            unique.append(id)
+    return unique[:100]
+
+def buildRouter(bot_id, default_limit):
+    # The commands and options the bot understands
+    parser = router(bot_id, default_limit)
+    # First so "more zendesk" continues, but only at the start so "tell me more about zendesk" still searches
+    parser.command(["more"], leading=True, more=True)
+    parser.command(["zendesk"], providers=("zendesk",))
+    parser.command(["jira"], providers=("jira",))
+    parser.command(["sf", "salesforce"], providers=("salesforce",))
+    parser.command(["text"], providers=("zendesk", "jira"), textonly=True)
+    parser.command(["help"], help=True)
+    parser.option("live", live=True)
+    return parser
+
+# Salesforce fields the replies render for each object type, in the order replies list the types
+sf_fields = collections.OrderedDict([
+    ("Account", ["Id", "Name", "Active_Support_Licenses__c", "Account_Manager__c"]),
+    ("Contact", ["Id", "Name", "Email"]),
+    ("User", ["Id", "Name", "Email"]),
+    ("Lead", ["Id", "Name", "Email", "Company", "Title"]),
+])
+
+# Template for one Salesforce record in a Slack reply, by object type
+sf_templates = {
+    "Account": "<https://%(instance)s/%(Id)s|%(Name)s>\n>*Licenses*: %(Active_Support_Licenses__c)s\n"
+               ">*Account Manager*: %(Account_Manager__c)s\n",
+    "Contact": "<https://%(instance)s/%(Id)s|%(Name)s>\n>*Email*: %(Email)s\n",
+    "User": "<https://%(instance)s/%(Id)s|%(Name)s>\n>*Email*: %(Email)s\n",
+    "Lead": "<https://%(instance)s/%(Id)s|%(Name)s>\n>*Email*: %(Email)s\n>*Company*: %(Company)s\n"
+            ">*Title*: %(Title)s\n",
+}
+
+def respondSFData(records, instance):
+    # Function to render Salesforce results for Slack, one record at a time. Each object type's heading, e.g.
+    # `Accounts`, goes out with its first record.
+    for r_type in sf_fields:
+        heading = "`%ss`\n" % r_type
+        for record in records.get(r_type, []):
+            values = dict(record, instance=instance)
+            if r_type == "Account":
+                values["Active_Support_Licenses__c"] = (values["Active_Support_Licenses__c"] or "").replace("\n", " ")
+            yield heading + sf_templates[r_type] % values
+            heading = ""
 
 class sfdc():
+    # A Salesforce session shared by every worker. Logs in on first use and again only when the session expires.
+    # Records looked up by ID in one SOQL query
+    id_batch = 200
 
     def __init__(self, options):
         self.options = options
-
-        self.sf = Salesforce(username=options["username"], password=options["password"],
-                             security_token=options["token"])
-
-    def getRecords(self, query):
-        self.query = query
-        print "Searching SFDC for %s" % self.query
-
-        self.contacts = []
-        self.accounts = []
-        self.users = []
-        self.leads = []
-
-        results = self.sf.quick_search(self.query)
-        if not results:
-            return False
-
-        for record in results:
-            if record['attributes']['type'] == 'Contact':
-                self.contacts.append(self.sf.Contact.get(record["Id"]))
-            elif record['attributes']['type'] == 'User':
-                self.users.append(self.sf.User.get(record["Id"]))
-            elif record['attributes']['type'] == 'Account':
-                self.accounts.append(self.sf.Account.get(record["Id"]))
-            elif record['attributes']['type'] == 'Lead':
-                self.leads.append(self.sf.Lead.get(record["Id"]))
-
-        return True
-
-def main():
-
-    # Get all ZD Users and Orgs
-    if not (os.path.isfile("/tmp/zd_users_list.pickle") and os.path.isfile("/tmp/zd_orgs_list.pickle")) \
-            or arguments["--refresh-cache"]:
-        zd_users_list = getZDOutput(zd_credentials, zd_params, "users")
-        zd_orgs_list = getZDOutput(zd_credentials, zd_params, "organizations")
-        pickle.dump(zd_users_list, open("/tmp/zd_users_list.pickle", 'wb'))
-        pickle.dump(zd_orgs_list, open("/tmp/zd_orgs_list.pickle", 'wb'))
-    else:
-        zd_users_list = pickle.load(open("/tmp/zd_users_list.pickle", 'rb'))
-        zd_orgs_list = pickle.load(open("/tmp/zd_orgs_list.pickle", 'rb'))
-
-    global zd_users
-    zd_users = {}
-    for user in zd_users_list:
-        zd_users[user["id"]] = {"name": user["name"], "email" : user["email"]}
-
-    global zd_orgs
-    zd_orgs = {}
-    for org in zd_orgs_list:
-        zd_orgs[org["id"]] = {"name": org["name"]}
-
-    del(zd_users_list)
-    del(zd_orgs_list)
-
-    # Instantiate Slack API object
-    global rocketsearch
-    rocketsearch = SlackClient(slackToken)
-
-    # Connect to Slack Real-Time Messaging
-    if rocketsearch.rtm_connect():
-        print("RocketSearch: connected and running!")
+        self.lock = threading.Lock()
+        self.sf = None
+
+    def connect(self, stale):
+        # Replaces the session, unless another worker already replaced the stale one
+        with self.lock:
+            if self.sf is stale:
+                logger.info("Logging in to Salesforce as %s", self.options["username"])
+                session = timeout_session(self.options["timeout"])
+                observeResponses(session, "salesforce")
+                self.sf = Salesforce(username=self.options["username"], password=self.options["password"],
+                                     security_token=self.options["token"], session=session)
+            return self.sf
+
+    def instance(self):
+        # The Salesforce host records link to. Results from the shared cache can arrive before this process has
+        # logged in.
+        return (self.sf or self.connect(None)).sf_instance
+
+    def call(self, name, request):
+        # Runs request against the session, logging in again and retrying once if the session has expired
+        sf = self.sf or self.connect(None)
+        try:
+            return self.timed(name, request, sf)
+        except SalesforceExpiredSession:
+            logger.info("Salesforce session expired.")
+            metrics.count("rocketsearch_upstream_retries_total", provider="salesforce", call=name)
+        return self.timed(name, request, self.connect(sf))
+
+    def timed(self, name, request, sf):
+        status = "error"
+        outbound.acquire("salesforce")
+        try:
+            with metrics.timed("upstream", provider="salesforce", call=name):
+                result = request(sf)
+            status = "ok"
+            return result
+        finally:
+            metrics.count("rocketsearch_upstream_requests_total", provider="salesforce", call=name, status=status)
+
+    def getRecords(self, query, limit):
+        # Quick searches Salesforce and returns the first limit hits as a dict of object type to records, and a
+        # cursor for the rest of the hits.
+        logger.debug("Searching SFDC for %s", query)
+
+        results = self.call("quick_search", lambda sf: sf.quick_search(query))
+        # Newer API versions wrap the hits in a dict
+        if isinstance(results, dict):
+            results = results.get("searchRecords")
+        hits = [[record['attributes']['type'], record["Id"]] for record in results or []
+                if record['attributes']['type'] in sf_fields]
+        return self.continueRecords({"hits": hits}, limit)
+
+    def continueRecords(self, cursor, limit):
+        # Fetches the next limit of a quick search's hits. Each object type is fetched with SOQL queries asking
+        # only for the fields we reply with, for up to id_batch records each so the query URL stays short enough.
+        # Returns them and a cursor for the rest, or None if there are no more.
+        hits = cursor["hits"]
+        # Object type -> record IDs, in the order Salesforce ranked them
+        ids = collections.OrderedDict()
+        for r_type, r_id in hits[:limit]:
+            ids.setdefault(r_type, []).append(r_id)
+
+        records = {}
+        for r_type, r_ids in ids.items():
+            found = {}
+            for i in range(0, len(r_ids), self.id_batch):
+                batch = r_ids[i:i + self.id_batch]
+                soql = "SELECT %s FROM %s WHERE Id IN (%s)" % (", ".join(sf_fields[r_type]), r_type,
+                                                               ", ".join("'%s'" % r_id for r_id in batch))
+                found.update((record["Id"], record)
+                             for record in self.call("query_all", lambda sf, soql=soql: sf.query_all(soql))["records"])
+            records[r_type] = [found[r_id] for r_id in r_ids if r_id in found]
+        return [records, {"hits": hits[limit:]} if hits[limit:] else None]
+
+def repeat(interval, func, name, delay=None):
+    # Calls func every interval seconds on a background thread for as long as the bot runs. The first call is
+    # after delay seconds, or after interval seconds if there's no delay given.
+    def forever():
+        sleep(interval if delay is None else delay)
         while True:
             try:
-                # Create message objects for any incoming messages. Other RTM events trigger an exception.
-                message = slack(message=rocketsearch.rtm_read()[0])
-                print message.message
-                # If it is a message and the bot didn't sent it, continue.
-                if message and message.text and not message.isBot:
-                    # Check whether the bot was invoked.
-                    if message.checkInvoked():
-                        # If so, check whether there were quotes in the message. If not, read back later.
-                        if not message.search.getSearchParams(message) and message.search.invoked:
-                            if message.search.help:
-                                if not message.isDM:
-                                    message.response("Happy to help. Check your direct messages.")
-                                    # Update destination channel to the user's ID, thus sending a direct message.
-                                    message.channel = message.user
-                                message.response(help_string)
-                            else:
-                                message.response("No search parameters found.")
-                            sleep(1)
-                            continue
-                        # Check for a message specified result limit
-                        message.search.getLimit(message)
-                        # Check to ensure there's no characters we can't turn into a URL.
-                        try:
-                            str(message.search.string)
-                        except UnicodeEncodeError as e:
-                            message.search.string = message.search.string.encode("ascii", "ignore")
-                            print message.search.string, type (message.search.string)
-                        # Run the search parameters against the Zendesk Query API
-                        if message.search.zd:
-                            zd_params["query"] = message.search.string
-                            try:
-                                zd_data = getZDOutput(zd_credentials, zd_domain, "search", params=zd_params)
-                            except requests.exceptions.ReadTimeout:
-                                message.response("Unable to connect to Zendesk.")
-                                sleep(1)
-                                continue
-                            zd_tickets = parseZDOutput(zd_data)
-                            if zd_tickets:
-                                message.response(respondZDData(zd_tickets, message.search.result_limit))
-                            else:
-                                message.response("No results in Zendesk for your search.")
-                        # Run the search parameters against the JIRA Search API
-                        if message.search.jira:
-                            global jira
-                            jira = connectToJira(jr_options)
-                            # Get JIRA ticket IDs which match the search
-                            try:
-                                jr_tickets = getJiraTickets(jira, message.search.string, message.search.textonly)
-                            except JIRAError as e:
-                                # Problem with the query string are returned as JIRAError objects
-                                message.response("*Error with JIRA Search*: _%s_" % e.text)
-                                sleep(1)
-                                continue
-                            jr_response = ""
-                            result = 0
-                            for ticket in jr_tickets:
-                                # Create ticket objects with populated fields based on JIRA ticket ID.
-                                ticket = jira_bug(ticket)
-                                if result < message.search.result_limit:
-                                    result += 1
-                                    print "Result number %d of limit %d" % (result, message.search.result_limit)
-                                    jr_response = jr_response + ticket.respondBugDetails()
-                            if jr_response:
-                                message.response(jr_response)
-                            else:
-                                message.response("No results in JIRA for your search.")
-                        if message.search.sfdc:
-                            try:
-                                sfdata = sfdc(sf_options)
-                                if not sfdata.getRecords(message.search.string):
-                                    message.response("No results in Salesforce for your search")
-                                    sleep(1)
-                                    continue
-                            except Exception as e:
-                                if SalesforceMalformedRequest:
-                                    message.response("*There was an error in your SalesForce search.*\n>_%s_" % str(e))
-                                else:
-                                    message.response("There's something wrong with SalesForce right now. Please let"\
-                                                     "your rocketsearch admin know")
-                                    print str(e)
-                            else:
-                                sf_response = ""
-                                if sfdata.accounts:
-                                    sf_response += "`Accounts`\n"
-                                    for record in sfdata.accounts:
-                                        sf_response += "<https://%s/%s|%s>\n>*Licenses*: %s\n>*Account Manager*: %s\n" \
-                                                        % (sfdata.sf.sf_instance, record["Id"], record["Name"],
-                                                        record["Active_Support_Licenses__c"].replace("\n", " "),
-                                                        record["Account_Manager__c"])
-                                if sfdata.contacts:
-                                    sf_response += "`Contacts`\n"
-                                    for record in sfdata.contacts:
-                                        sf_response += "<https://%s/%s|%s>\n>*Email*: %s\n" \
-                                                       % (sfdata.sf.sf_instance, record["Id"], record["Name"],
-                                                          record["Email"])
-                                if sfdata.users:
-                                    sf_response += "`Users`\n"
-                                    for record in sfdata.users:
-                                        sf_response += "<https://%s/%s|%s>\n>*Email*: %s\n" \
-                                                       % (sfdata.sf.sf_instance, record["Id"], record["Name"],
-                                                          record["Email"])
-                                if sfdata.leads:
-                                    sf_response += "`Leads`\n"
-                                    for record in sfdata.leads:
-                                        sf_response += "<https://%s/%s|%s>\n>*Email*: %s\n>*Company*: %s\n>" \
-                                                       "*Title*: %s\n" \
-                                                       % (sfdata.sf.sf_instance, record["Id"], record["Name"],
-                                                          record["Email"], record["Company"], record["Title"])
-                                message.response(sf_response)
-                        sleep(1)
+                func()
+            except Exception as e:
+                logger.warning("%s failed, trying again in %d seconds: %s", name, interval, e)
+            sleep(interval)
+    thread = threading.Thread(target=forever, name=name)
+    thread.daemon = True
+    thread.start()
+
+class reply:
+    # Buffers a provider's reply as a list of rendered records and posts it in chunks that fit in one Slack
+    # message. Chunks split between records and are posted as soon as they are full, so the first results show
+    # up while the rest are still rendering. Once closed, e.g. when the provider misses its deadline, nothing
+    # more is posted.
+    def __init__(self, provider, post, limit):
+        self.provider = provider
+        self.post = post
+        self.limit = limit
+        # Seconds spent posting, so it can be told apart from rendering
+        self.posting = 0
+        self.parts = []
+        self.size = 0
+        self.records = 0
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def add(self, text):
+        # Adds a record, posting what's buffered first if the record won't fit in the same message
+        if self.size + len(text) > self.limit:
+            self.flush()
+        if len(text) > self.limit:
+            # Only a record too big for a message on its own is ever cut
+            text = text[:self.limit - 4] + "...\n"
+        self.parts.append(text)
+        self.size += len(text)
+
+    def extend(self, records):
+        # Adds rendered records, counting them so callers can tell if there were any
+        start, posting = time(), self.posting
+        for record in records:
+            self.add(record)
+            self.records += 1
+        metrics.observe("rocketsearch_stage_seconds", time() - start - (self.posting - posting), stage="render",
+                        provider=self.provider)
+
+    def flush(self):
+        if not self.parts:
+            return
+        text = "".join(self.parts)
+        self.parts = []
+        self.size = 0
+        start = time()
+        with self.lock:
+            if not self.closed:
+                self.post(text)
+        self.posting += time() - start
+
+    def close(self):
+        # Waits for a post in progress to finish, then drops the rest
+        with self.lock:
+            self.closed = True
+
+class task:
+    # A unit of work run by a pool. Callers can wait on it and then read its result or error.
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.result = None
+        self.error = None
+        self.finished = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args, **self.kwargs)
+        except Exception as e:
+            self.error = e
+            logger.exception("%s failed", getattr(self.func, "__name__", self.func))
+        finally:
+            self.finished.set()
+
+    def wait(self, timeout=None):
+        # Returns True if the task finished within the timeout
+        self.finished.wait(timeout)
+        return self.finished.is_set()
+
+class pool:
+    # A fixed number of daemon threads running tasks from a shared queue
+    def __init__(self, size, name="worker"):
+        self.tasks = Queue.Queue()
+        self.threads = []
+        for i in range(size):
+            thread = threading.Thread(target=self.work, name="%s-%d" % (name, i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def work(self):
+        while True:
+            self.tasks.get().run()
+
+    def submit(self, func, *args, **kwargs):
+        t = task(func, args, kwargs)
+        self.tasks.put(t)
+        return t
+
+class dispatcher:
+    # Hands invoked messages to a bounded pool of workers. Messages from the same channel are handled one at a
+    # time and in the order they arrived, so each channel's replies still come back in order.
+    def __init__(self, handler, workers):
+        self.handler = handler
+        self.pool = pool(workers, "dispatch")
+        self.lock = threading.Lock()
+        # Channel ID -> messages waiting behind the one currently being handled for that channel
+        self.channels = {}
+
+    def submit(self, message):
+        with self.lock:
+            if message.channel in self.channels:
+                self.channels[message.channel].append(message)
+                return
+            self.channels[message.channel] = collections.deque()
+        self.pool.submit(self.run, message.channel, message)
+
+    def depth(self):
+        # Messages waiting for a worker, whether in the pool's queue or behind another message in their channel
+        with self.lock:
+            return self.pool.tasks.qsize() + sum(len(waiting) for waiting in self.channels.values())
+
+    def run(self, channel, message):
+        try:
+            self.handler(message)
+        finally:
+            with self.lock:
+                if self.channels[channel]:
+                    # Go to the back of the pool queue so one busy channel can't starve the others
+                    self.pool.submit(self.run, channel, self.channels[channel].popleft())
                 else:
-                    print message
-            except websocket._exceptions.WebSocketConnectionClosedException as e:
-                sleep(10)
-                print "Connection to Slack RTM dropped. Attempting to reconnect."
-                if rocketsearch.rtm_connect():
-                    print "Successfully reconnected!"
-                    pass
+                    del self.channels[channel]
+
+class record_cache:
+    # Tickets and issues recently looked up by ID. Only the IDs that aren't cached are fetched, in one batch, and
+    # records are kept for a short while only, as they change more often than search results are read.
+    def __init__(self, ttl, size):
+        self.ttl = ttl
+        self.size = size
+        self.lock = threading.Lock()
+        # (provider, ID) -> (expiry time, record), least recently used first
+        self.records = collections.OrderedDict()
+
+    def get(self, provider, ids, fetch):
+        # Returns {ID: record} for each of ids that exists. fetch(ids) returns the same for the IDs not cached.
+        found = {}
+        missing = []
+        with self.lock:
+            for id in ids:
+                entry = self.records.pop((provider, id), None)
+                if entry and entry[0] > time():
+                    self.records[(provider, id)] = entry
+                    found[id] = entry[1]
                 else:
-                    print "Still can't connect. Trying again."
-                    continue
-            except (IndexError, KeyError) as e:
-                #print str(e)
+                    missing.append(id)
+        metrics.count("rocketsearch_record_cache_total", len(found), provider=provider, result="hit")
+        metrics.count("rocketsearch_record_cache_total", len(missing), provider=provider, result="miss")
+        if missing:
+            fetched = fetch(missing)
+            if self.ttl > 0:
+                with self.lock:
+                    for id, record in fetched.items():
+                        self.records[(provider, id)] = (time() + self.ttl, record)
+                    while len(self.records) > self.size:
+                        self.records.popitem(last=False)
+            found.update(fetched)
+        return found
+
+class cursor_store:
+    # Where the last search in each channel or thread got to with each provider, so "more" can carry on from
+    # there with one upstream call rather than searching again with a bigger limit. Cursors are kept for a short
+    # while only.
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # (channel, thread) -> {provider: (expiry time, cursor)}
+        self.cursors = {}
+
+    def start(self, key):
+        # A new search replaces the last one's cursors
+        with self.lock:
+            self.cursors.pop(key, None)
+            # Drop the cursors nobody came back for
+            now = time()
+            for old in [old for old, found in self.cursors.items() if max(found.values())[0] <= now]:
+                del self.cursors[old]
+
+    def put(self, key, provider, cursor):
+        # Keeps a provider's cursor, or forgets it when there are no more results
+        with self.lock:
+            found = self.cursors.setdefault(key, {})
+            if cursor:
+                found[provider] = (time() + self.ttl, cursor)
+            else:
+                found.pop(provider, None)
+                if not found:
+                    del self.cursors[key]
+
+    def take(self, key):
+        # Returns {provider: cursor} for the unexpired cursors. They are kept until the next page replaces them, so
+        # a page that fails can be asked for again.
+        now = time()
+        with self.lock:
+            return dict((provider, cursor) for provider, (expires, cursor) in self.cursors.get(key, {}).items()
+                        if expires > now)
+
+class shared_results(sqlite_store):
+    # Second level of the result cache, in a file every bot process on the host shares. Results are kept as
+    # JSON, so a process can use what another one fetched.
+    version = 2
+    schema = """
+        CREATE TABLE results (key TEXT PRIMARY KEY, expires REAL, result TEXT);
+        CREATE INDEX results_expires ON results (expires);
+    """
+
+    def __init__(self, path):
+        sqlite_store.__init__(self, path)
+        self.writes = 0
+
+    def get(self, key):
+        # Returns (expiry time, result), or None if there's no fresh result for key. A problem with the file only
+        # means the provider gets asked.
+        try:
+            row = self.db().execute("SELECT expires, result FROM results WHERE key = ?",
+                                    (json.dumps(key),)).fetchone()
+        except sqlite3.Error as e:
+            logger.warning("Unable to read the shared result cache: %s", e)
+            return None
+        if row and row[0] > time():
+            return row[0], json.loads(row[1])
+        return None
+
+    def put(self, key, result, expires):
+        db = self.db()
+        try:
+            with db:
+                db.execute("INSERT OR REPLACE INTO results (key, expires, result) VALUES (?, ?, ?)",
+                           (json.dumps(key), expires, json.dumps(result)))
+                # Now and then, clear out what has expired
+                self.writes += 1
+                if self.writes % 100 == 0:
+                    db.execute("DELETE FROM results WHERE expires < ?", (time(),))
+        except sqlite3.Error as e:
+            logger.warning("Unable to write the shared result cache: %s", e)
+
+class result_cache:
+    # Remembers provider results for a while, keyed on provider, normalised query and limit. Once full, the least
+    # recently used result is evicted. A query that arrives while the same query is already being fetched waits
+    # for that fetch ("single-flight") instead of making its own upstream call. With a shared store, results
+    # fetched by other bot processes are used too.
+    def __init__(self, ttl, size, shared=None):
+        self.ttl = ttl
+        self.size = size
+        self.shared = shared
+        self.lock = threading.Lock()
+        # Key -> (expiry time, result), least recently used first
+        self.results = collections.OrderedDict()
+        # Key -> task for the fetch in progress
+        self.inflight = {}
+
+    def get(self, provider, query, limit, fetch):
+        # Returns the result for the query, calling fetch() only if no fresh result is cached or in flight
+        key = (provider, " ".join(query.split()), limit)
+        leader = False
+        with self.lock:
+            if key in self.results:
+                expires, result = self.results.pop(key)
+                # Expired results stay until they are replaced or evicted, in case the provider goes down
+                self.results[key] = (expires, result)
+                if expires > time():
+                    metrics.count("rocketsearch_cache_requests_total", provider=provider, result="hit")
+                    logger.debug("Cache hit for %s %s", provider, key[1], extra={"sample": "cache"})
+                    return result
+            flight = self.inflight.get(key)
+            if flight:
+                metrics.count("rocketsearch_cache_requests_total", provider=provider, result="coalesced")
+            else:
+                metrics.count("rocketsearch_cache_requests_total", provider=provider, result="miss")
+                flight = self.inflight[key] = task(fetch, (), {})
+                leader = True
+        if not leader:
+            # Someone else is already fetching this
+            flight.wait()
+        else:
+            expires = time() + self.ttl
+            try:
+                found = self.shared.get(key) if self.shared and self.ttl > 0 else None
+                if found:
+                    metrics.count("rocketsearch_cache_requests_total", provider=provider, result="shared")
+                    expires, flight.result = found
+                else:
+                    flight.result = fetch()
+                    if self.shared and self.ttl > 0:
+                        self.shared.put(key, flight.result, expires)
+            except Exception as e:
+                flight.error = e
+            with self.lock:
+                del self.inflight[key]
+                if flight.error is None and self.ttl > 0:
+                    self.results[key] = (expires, flight.result)
+                    while len(self.results) > self.size:
+                        self.results.popitem(last=False)
+            flight.finished.set()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def stale(self, provider, query, limit):
+        # Returns (age in seconds, result) for the last result for the query, however old, or None if there's none
+        key = (provider, " ".join(query.split()), limit)
+        with self.lock:
+            if key not in self.results:
+                return None
+            expires, result = self.results[key]
+        return time() - (expires - self.ttl), result
+
+class metrics_registry:
+    # Labelled counters and latency histograms for each stage of handling a message, served in the Prometheus
+    # text format. Stages timed on a thread that is tracing are also added to that message's trace.
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (name, labels) -> value
+        self.counters = collections.defaultdict(float)
+        # (name, labels) -> [count per bucket..., sum, count]
+        self.histograms = {}
+        # (name, labels) -> function returning the current value
+        self.gauges = {}
+        self.local = threading.local()
+        self.trace_log = None
+
+    def count(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] += amount
+
+    def gauge(self, name, func, **labels):
+        # Registers a value read when the metrics are scraped
+        self.gauges[(name, tuple(sorted(labels.items())))] = func
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[i] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+        trace = getattr(self.local, "trace", None)
+        if trace is not None:
+            trace.append(dict(labels, seconds=round(seconds, 4)))
+
+    @contextlib.contextmanager
+    def timed(self, stage, **labels):
+        # Times the with block as one run of stage, counting an error if it raises
+        start = time()
+        try:
+            yield
+        except Exception:
+            self.count("rocketsearch_stage_errors_total", stage=stage, **labels)
+            raise
+        finally:
+            self.observe("rocketsearch_stage_seconds", time() - start, stage=stage, **labels)
+
+    def tracing(self, trace):
+        # Adds the stages timed on this thread to trace (a list), or stops if trace is None
+        self.local.trace = trace
+
+    def openTrace(self, path):
+        self.trace_log = open(path, "a")
+
+    def writeTrace(self, record):
+        # Appends one message's trace to the trace log as a JSON line
+        line = json.dumps(record) + "\n"
+        with self.lock:
+            self.trace_log.write(line)
+            self.trace_log.flush()
+
+    def render(self):
+        def labelled(name, labels):
+            if not labels:
+                return name
+            return "%s{%s}" % (name, ",".join('%s="%s"' % (key, str(value).replace("\\", "\\\\").replace('"', '\\"')
+                                                                .replace("\n", "\\n")) for key, value in labels))
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, list(value)) for key, value in self.histograms.items())
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append("# TYPE %s counter" % name)
+                typed.add(name)
+            lines.append("%s %s" % (labelled(name, labels), value))
+        for (name, labels), func in sorted(self.gauges.items()):
+            if name not in typed:
+                lines.append("# TYPE %s gauge" % name)
+                typed.add(name)
+            lines.append("%s %s" % (labelled(name, labels), func()))
+        for (name, labels), histogram in histograms:
+            if name not in typed:
+                lines.append("# TYPE %s histogram" % name)
+                typed.add(name)
+            for bound, count in zip(self.buckets, histogram):
+                lines.append("%s %d" % (labelled(name + "_bucket", labels + (("le", bound),)), count))
+            lines.append("%s %d" % (labelled(name + "_bucket", labels + (("le", "+Inf"),)), histogram[-1]))
+            lines.append("%s %s" % (labelled(name + "_sum", labels), histogram[-2]))
+            lines.append("%s %d" % (labelled(name + "_count", labels), histogram[-1]))
+        return "\n".join(lines) + "\n"
+
+    def serve(self, address, port):
+        # Serves /metrics on a background thread
+        registry = self
+        class handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
                 pass
-            sleep(1)
+        server = BaseHTTPServer.HTTPServer((address, port), handler)
+        thread = threading.Thread(target=server.serve_forever, name="metrics")
+        thread.daemon = True
+        thread.start()
+        logger.info("Serving metrics on http://%s:%d/metrics", address, port)
+
+# Shared by everything that's timed or counted
+metrics = metrics_registry()
+
+class token_bucket:
+    # Lets calls through at up to rate a second, with bursts of up to burst calls when there's been capacity
+    # to spare. A pause (e.g. from Retry-After) holds every call until it's over.
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        # The most burst allowed, whatever the destination says
+        self.max_burst = burst
+        self.tokens = burst
+        self.updated = time()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, deadline=None):
+        # Waits for a token. Returns the seconds waited, or None if the wait would go past the deadline.
+        start = time()
+        while True:
+            with self.lock:
+                now = time()
+                self.refill(now)
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return now - start
+                    wait = (1 - self.tokens) / self.rate
+            if deadline is not None and now + wait > deadline:
+                return None
+            sleep(wait)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time() + seconds)
+            self.tokens = 0
+            self.updated = time()
+
+    def limit(self, rate, burst, remaining, reset):
+        # Follows what the destination says about its limit: its rate (calls a second), its burst, and how many
+        # calls are left, pausing for reset seconds once there are none
+        with self.lock:
+            self.refill(time())
+            if rate:
+                self.rate = rate
+            if rate or burst:
+                # Worked out afresh each time, so the burst comes back if the destination's limit does
+                self.burst = max(1, min(self.max_burst, burst or self.rate * 10))
+            if remaining is not None:
+                self.tokens = min(self.tokens, remaining)
+                if remaining < 1 and reset:
+                    self.paused_until = max(self.paused_until, time() + reset)
+
+class scheduler:
+    # Outbound rate limits. One token bucket per destination (zendesk, jira, salesforce, and slack:<channel>
+    # for each channel posted to), adapting to the Retry-After and rate limit headers the destinations send.
+    def __init__(self, rates):
+        # Destination type -> (calls a second, burst)
+        self.rates = rates
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, destination):
+        with self.lock:
+            bucket = self.buckets.get(destination)
+            if bucket is None:
+                if len(self.buckets) > 1000:
+                    # Forget channels that haven't been posted to lately
+                    for key, idle in self.buckets.items():
+                        idle.refill(time())
+                        if idle.tokens >= idle.burst and idle.paused_until < time():
+                            del self.buckets[key]
+                rate, burst = self.rates[destination.split(":")[0]]
+                bucket = self.buckets[destination] = token_bucket(rate, burst)
+            return bucket
+
+    def acquire(self, destination, deadline=None):
+        # Waits until a call to destination may go. Returns False if that would be after the deadline.
+        waited = self.bucket(destination).acquire(deadline)
+        if waited is None:
+            metrics.count("rocketsearch_rate_limited_total", destination=destination.split(":")[0])
+            return False
+        if waited > 0:
+            metrics.observe("rocketsearch_stage_seconds", waited, stage="throttle",
+                            destination=destination.split(":")[0])
+        return True
 
-if __name__ == "__main__":
+    def observe(self, destination, status, headers):
+        # Adapts to a response's headers. Retry-After pauses the destination, and so does running out of calls.
+        headers = dict((key.lower(), value) for key, value in (headers or {}).items())
+        bucket = self.bucket(destination)
+        retry_after = headerNumber(headers, "retry-after")
+        if status == 429 or (status == 503 and retry_after is not None):
+            logger.warning("%s is rate limited, pausing for %s seconds", destination, retry_after or 1)
+            metrics.count("rocketsearch_upstream_throttled_total", destination=destination.split(":")[0])
+            bucket.pause(retry_after or 1)
+            return
+        # Zendesk sends its limit a minute. JIRA sends the size of its token bucket and how many calls it adds
+        # back every so many seconds. Both send the calls left.
+        rate = None
+        per_minute = headerNumber(headers, "x-rate-limit")
+        fill_rate = headerNumber(headers, "x-ratelimit-fillrate")
+        interval = headerNumber(headers, "x-ratelimit-interval-seconds")
+        if per_minute:
+            rate = per_minute / 60.0
+        elif fill_rate and interval:
+            rate = fill_rate / interval
+        burst = headerNumber(headers, "x-ratelimit-limit")
+        remaining = headerNumber(headers, "x-rate-limit-remaining", "x-ratelimit-remaining")
+        reset = None
+        # Salesforce sends how much of its rolling 24 hour allowance is used, e.g. "api-usage=25/15000". Once it's
+        # used up, check again every minute.
+        usage = re.search(r'api-usage=(\d+)/(\d+)', headers.get("sforce-limit-info", ""))
+        if usage:
+            remaining = float(usage.group(2)) - float(usage.group(1))
+            reset = 60
+        if rate or burst or remaining is not None:
+            bucket.limit(rate, burst, remaining, reset)
+
+def observeResponses(session, destination):
+    # Feeds every response a requests session gets to the rate limiter, for clients that don't hand them back
+    # to us, whether the call worked or not
+    def observe(response, *args, **kwargs):
+        status, headers = response.status_code, response.headers
+        if status == 403 and "REQUEST_LIMIT_EXCEEDED" in response.text:
+            # Salesforce's way of saying the allowance is used up
+            status, headers = 429, dict(headers, **{"Retry-After": "60"})
+        outbound.observe(destination, status, headers)
+    session.hooks["response"].append(observe)
+
+def headerNumber(headers, *names):
+    # Returns the first of the named (lowercase) headers that holds a number
+    for name in names:
+        try:
+            return float(headers[name])
+        except (KeyError, TypeError, ValueError):
+            pass
+    return None
+
+# The time the search running on each thread must finish by
+search_deadlines = threading.local()
+
+def setSearchDeadline(deadline):
+    # Sets (or with None, clears) when the current thread's search must finish by
+    search_deadlines.at = deadline
+
+def searchDeadline():
+    return getattr(search_deadlines, "at", None)
+
+def cappedTimeout(timeout, deadline):
+    # A request timeout, either seconds or (connect, read), cut down to the time left before deadline
+    if deadline is None:
+        return timeout
+    left = max(deadline - time(), 0.1)
+    if isinstance(timeout, tuple):
+        return tuple(min(part, left) for part in timeout)
+    return min(timeout, left)
+
+class ProviderUnavailable(Exception):
+    # Raised without calling a provider while its circuit breaker is open
+    pass
+
+def isOutage(e):
+    # Whether an error means the provider is in trouble, rather than that it rejected the query
+    if isinstance(e, ProviderUnavailable):
+        return True
+    if isinstance(e, ZendeskError):
+        return e.status is None or e.status >= 500 or e.status == 429
+    if isinstance(e, JIRAError):
+        return e.status_code is None or e.status_code >= 500 or e.status_code == 429
+    return not isinstance(e, SalesforceMalformedRequest)
+
+class circuit_breaker:
+    # Opens after failures outages in a row, so calls fail straight away instead of waiting on a sick provider.
+    # After cooldown seconds one call is let through to test it. If that works the breaker closes again.
+    def __init__(self, failures, cooldown):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.failed = 0
+        self.opened = None
+        self.testing = False
+
+    def allow(self):
+        with self.lock:
+            if self.opened is None:
+                return True
+            if not self.testing and time() - self.opened >= self.cooldown:
+                self.testing = True
+                return True
+            return False
 
-    arguments = docopt(__doc__)
+    def success(self):
+        with self.lock:
+            self.failed = 0
+            self.opened = None
+            self.testing = False
+
+    def failure(self):
+        # Returns True if this failure opened the breaker
+        with self.lock:
+            self.failed += 1
+            self.testing = False
+            if self.opened is not None:
+                # The test call failed. Wait another cooldown.
+                self.opened = time()
+            elif self.failed >= self.failures:
+                self.opened = time()
+                return True
+            return False
 
-    ### Configuration ###
-    if "~" in arguments['--config']:
-        pattern = re.compile('~')
-        arguments['--config'] = pattern.sub(os.path.expanduser("~"), arguments['--config'])
-    if not os.path.exists(arguments['--config']):
-        logger.error("Specified configuration file does not exist!")
-        exit(1)
-    with open(arguments['--config'], 'r') as ymlfile:
-        cfg = yaml.load(ymlfile)
+class upstream:
+    # Calls to one provider, through its circuit breaker. When hedging is on, a call still running after the
+    # provider's recent p95 latency gets a second, identical call, and whichever answers first is used.
+    def __init__(self, name, options):
+        self.name = name
+        self.breaker = circuit_breaker(options["breaker_failures"], options["breaker_cooldown"])
+        self.hedge = options["hedge"]
+        # Latencies of the last 100 calls that worked
+        self.latencies = collections.deque(maxlen=100)
+
+    def call(self, fetch):
+        if not self.breaker.allow():
+            metrics.count("rocketsearch_breaker_rejected_total", provider=self.name)
+            raise ProviderUnavailable("%s has failed %d times in a row" % (providers[self.name][0],
+                                                                          self.breaker.failed))
+        start = time()
+        try:
+            result = self.run(fetch)
+        except Exception as e:
+            if isOutage(e):
+                if self.breaker.failure():
+                    logger.warning("Circuit breaker for %s opened: %s", self.name, e)
+                    metrics.count("rocketsearch_breaker_opened_total", provider=self.name)
+            else:
+                self.breaker.success()
+            raise
+        self.breaker.success()
+        self.latencies.append(time() - start)
+        return result
+
+    def hedgeDelay(self):
+        # The p95 of recent calls, once there are enough of them to go on
+        if not self.hedge or len(self.latencies) < 20:
+            return None
+        return max(sorted(self.latencies)[int(len(self.latencies) * 0.95) - 1], 0.05)
+
+    def run(self, fetch):
+        delay = self.hedgeDelay()
+        if delay is None:
+            return fetch()
+        answers = Queue.Queue()
+        deadline = searchDeadline()
+        def attempt():
+            # On a hedge thread, so carry the search's deadline over
+            setSearchDeadline(deadline)
+            try:
+                answers.put((True, fetch()))
+            except Exception as e:
+                answers.put((False, e))
+            finally:
+                setSearchDeadline(None)
+        hedge_pool.submit(attempt)
+        attempts = 1
+        try:
+            ok, answer = answers.get(timeout=delay)
+        except Queue.Empty:
+            metrics.count("rocketsearch_hedged_requests_total", provider=self.name)
+            hedge_pool.submit(attempt)
+            attempts = 2
+            ok, answer = answers.get()
+        if not ok and attempts == 2:
+            # The other attempt may still work
+            ok, answer = answers.get()
+        if not ok:
+            raise answer
+        return answer
+
+class timeout_session(requests.Session):
+    # A requests session that gives every request a timeout, for clients that don't set one themselves
+    def __init__(self, timeout):
+        requests.Session.__init__(self)
+        self.timeout = timeout
+
+    def request(self, *args, **kwargs):
+        kwargs.setdefault("timeout", cappedTimeout(self.timeout, searchDeadline()))
+        return requests.Session.request(self, *args, **kwargs)
+
+def cachedSearch(name, key, message, fetch, out):
+    # Fetches a search's results through the result cache and the provider's circuit breaker. When the provider
+    # is down, replies with the last results for the same search, if there are any, noting how old they are.
+    try:
+        return search_cache.get(key, message.search.string, message.search.result_limit,
+                                lambda: upstreams[name].call(fetch))
+    except Exception as e:
+        if not isOutage(e):
+            raise
+        stale = search_cache.stale(key, message.search.string, message.search.result_limit)
+        if stale is None:
+            raise
+        age, result = stale
+        metrics.count("rocketsearch_stale_replies_total", provider=name)
+        out.add("_%s isn't answering (%s), so these results are from %d minutes ago._\n\n"
+                % (providers[name][0], e, max(age // 60, 1)))
+        return result
+
+# Added to replies answered from the local index
+index_note = "_Searched the local index. Add `live` after your query to search the provider directly._\n"
+
+def searchIndex(source, message):
+    # Answers plain word searches from the local index when it's turned on and has been built. Returns None when
+    # the provider has to be searched directly.
+    if not local_index or message.search.live or not isPlainText(message.search.string):
+        return None
+    return local_index.search(source, message.search.string, message.search.result_limit)
+
+def searchZendesk(message, out):
+    # Runs the search parameters against the Zendesk Query API and renders the reply into out
+    # Copy the shared parameters as other workers may be searching at the same time
+    params = dict(zd_params, query=message.search.string)
+    try:
+        if message.search.ids:
+            # Tickets asked for by number are read directly, which is much quicker than searching
+            zd_tickets = getZDTicketsById(zd_client, message.search.ids)
+            if zd_tickets:
+                respondMissing(out, message.search.ids, [ticket["id"] for ticket in zd_tickets], "#%s")
+                out.extend(respondZDData(zd_tickets, len(zd_tickets)))
+                return
+            # No such tickets, so search for the text instead
+        zd_tickets = searchIndex("zendesk", message)
+        if zd_tickets is not None:
+            out.extend(respondZDData(zd_tickets, message.search.result_limit))
+            if not out.records:
+                out.add("No results in Zendesk for your search.\n")
+            out.add(index_note)
+            return
+        zd_tickets, rest = cachedSearch("zendesk", "zendesk", message,
+                                        lambda: getZDTickets(zd_client, params, message.search.result_limit), out)
+    except ZendeskError as e:
+        if not isOutage(e):
+            # Zendesk rejected the query itself
+            out.add("*Error with Zendesk Search*: _%s_" % e)
+            return
+        logger.warning("Zendesk search failed: %s", e)
+        out.add("Unable to connect to Zendesk.")
+        return
+    if zd_tickets:
+        out.extend(respondZDData(zd_tickets, message.search.result_limit))
+        keepCursor(message, "zendesk", rest, message.search.result_limit, out)
+    else:
+        out.add("No results in Zendesk for your search.")
+
+def moreZendesk(message, out, cursor):
+    # Renders the next page of a Zendesk search into out
+    try:
+        zd_tickets, rest = upstreams["zendesk"].call(lambda: continueZDTickets(zd_client, cursor, cursor["limit"]))
+    except ZendeskError as e:
+        logger.warning("Zendesk search failed: %s", e)
+        out.add("Unable to connect to Zendesk.")
+        return
+    out.extend(respondZDData(zd_tickets, cursor["limit"]))
+    keepCursor(message, "zendesk", rest, cursor["limit"], out)
+
+def searchJira(message, out):
+    # Runs the search parameters against the JIRA Search API and renders the reply into out
+    if message.search.textonly:
+        jr_issues = searchIndex("jira", message)
+        if jr_issues is not None:
+            out.extend(jira_bug(issue["key"], issue["fields"]).respondBugDetails() for issue in jr_issues)
+            if not out.records:
+                out.add("No results in JIRA for your search.\n")
+            out.add(index_note)
+            return
+    rest = None
+    try:
+        if message.search.ids:
+            # Issues asked for by key are read in one search for just those keys
+            jr_tickets = getJiraIssuesByKey(jira, message.search.ids)
+            respondMissing(out, message.search.ids, [ticket["key"] for ticket in jr_tickets], "%s")
+        else:
+            jr_tickets, rest = cachedSearch("jira", "jira:text" if message.search.textonly else "jira", message,
+                                            lambda: getJiraTickets(jira, message.search.string,
+                                                                   message.search.textonly,
+                                                                   message.search.result_limit), out)
+    except JIRAError as e:
+        # Problem with the query string are returned as JIRAError objects
+        out.add("*Error with JIRA Search*: _%s_" % e.text)
+        return
+    # Create ticket objects from the fields returned by the search.
+    out.extend(jira_bug(ticket["key"], ticket["fields"]).respondBugDetails() for ticket in jr_tickets)
+    if not out.records:
+        out.add("No results in JIRA for your search.")
+    keepCursor(message, "jira", rest, message.search.result_limit, out)
+
+def moreJira(message, out, cursor):
+    # Renders the next page of a JIRA search into out
+    try:
+        jr_tickets, rest = upstreams["jira"].call(lambda: continueJiraTickets(jira, cursor, cursor["limit"]))
+    except JIRAError as e:
+        out.add("*Error with JIRA Search*: _%s_" % e.text)
+        return
+    out.extend(jira_bug(ticket["key"], ticket["fields"]).respondBugDetails() for ticket in jr_tickets)
+    keepCursor(message, "jira", rest, cursor["limit"], out)
+
+def respondMissing(out, ids, found, label):
+    # Notes the tickets or issues asked for by ID that don't exist, when some of them do
+    found = set(found)
+    missing = [label % id for id in ids if id not in found]
+    if missing and found:
+        out.add("_Not found: %s_\n\n" % ", ".join(missing))
+
+# Shown when a Salesforce search or its "more" fails for any reason other than the query
+sf_error = "There's something wrong with SalesForce right now. Please let your rocketsearch admin know"
+
+def searchSalesforce(message, out):
+    # Runs the search parameters against Salesforce quick search and renders the reply into out
+    try:
+        records, rest = cachedSearch("salesforce", "salesforce", message,
+                                     lambda: salesforce.getRecords(message.search.string,
+                                                                   message.search.result_limit), out)
+        if not records:
+            out.add("No results in Salesforce for your search")
+            return
+    except ProviderUnavailable:
+        raise
+    except Exception as e:
+        if isinstance(e, SalesforceMalformedRequest):
+            out.add("*There was an error in your SalesForce search.*\n>_%s_" % str(e))
+        else:
+            logger.warning("Salesforce search failed: %s", e)
+            out.add(sf_error)
+        return
+    out.extend(respondSFData(records, salesforce.instance()))
+    keepCursor(message, "salesforce", rest, message.search.result_limit, out)
+
+def moreSalesforce(message, out, cursor):
+    # Renders the next page of a Salesforce search into out
+    try:
+        records, rest = upstreams["salesforce"].call(lambda: salesforce.continueRecords(cursor, cursor["limit"]))
+    except ProviderUnavailable:
+        raise
+    except Exception as e:
+        logger.warning("Salesforce search failed: %s", e)
+        out.add(sf_error)
+        return
+    out.extend(respondSFData(records, salesforce.instance()))
+    keepCursor(message, "salesforce", rest, cursor["limit"], out)
+
+def keepCursor(message, name, cursor, limit, out):
+    # Remembers where a reply got to so "more" can carry on from there, and says so at the end of the reply
+    cursors.put((message.channel, message.thread), name, cursor and dict(cursor, limit=limit))
+    if cursor:
+        out.add("_More results in %s: send `more` to see them._\n" % providers[name][0])
+
+def continueSearch(message):
+    # Replies with the next page of each provider's results for the last search in the channel or thread
+    pending = cursors.take((message.channel, message.thread))
+    if not pending:
+        message.response("Nothing more to show. `more` continues the last search here for %d minutes after it."
+                         % max(cursor_ttl // 60, 1))
+        return
+    searchProviders(message, collections.OrderedDict(
+        (name, lambda message, out, name=name: providers[name][2](message, out, pending[name]))
+        for name in sorted(pending)))
+
+# Provider name -> (display name, search function, continuation function)
+providers = {
+    "zendesk": ("Zendesk", searchZendesk, moreZendesk),
+    "jira": ("JIRA", searchJira, moreJira),
+    "salesforce": ("Salesforce", searchSalesforce, moreSalesforce),
+}
+
+def runProvider(done, name, message, out, search, deadline):
+    # Runs one provider's search on the provider pool, then tells the waiting worker it has finished
+    metrics.tracing(message.trace)
+    setSearchDeadline(deadline)
+    try:
+        with metrics.timed("provider", provider=name):
+            search(message, out)
+    except ProviderUnavailable as e:
+        # Failing fast, with no earlier results to fall back on
+        out.add("_%s is unavailable right now (%s). Please try again in a minute._" % (providers[name][0], e))
+    except Exception as e:
+        logger.exception("%s search failed", providers[name][0])
+        out.add("There's something wrong with %s right now. Please let your rocketsearch admin know"
+                % providers[name][0])
+    out.flush()
+    metrics.tracing(None)
+    setSearchDeadline(None)
+    done.put(name)
+
+def searchProviders(message, searches):
+    # Queries the providers in parallel, with searches mapping each provider's name to the function to run.
+    # Each posts its reply in chunks as it renders them. A provider that misses its deadline gets a "timed out"
+    # note, and anything it renders after that is dropped.
+    done = Queue.Queue()
+    deadlines = {}
+    replies = {}
+    for name, search in searches.items():
+        deadlines[name] = time() + provider_deadlines[name]
+        replies[name] = reply(name, message.response, message_limit)
+        provider_pool.submit(runProvider, done, name, message, replies[name], search, deadlines[name])
+    while deadlines:
+        try:
+            del deadlines[done.get(timeout=max(min(deadlines.values()) - time(), 0))]
+        except Queue.Empty:
+            for name, deadline in deadlines.items():
+                if deadline <= time():
+                    del deadlines[name]
+                    replies[name].close()
+                    message.response("_%s timed out after %s seconds._" % (providers[name][0],
+                                                                           provider_deadlines[name]))
+
+def handleMessage(message):
+    # Handles an invoked message on a dispatcher worker. Times it, and records the stages it went through if
+    # there's a trace log.
+    message.trace = [] if metrics.trace_log else None
+    metrics.tracing(message.trace)
+    metrics.observe("rocketsearch_stage_seconds", time() - message.received, stage="queue")
+    try:
+        with metrics.timed("message"):
+            answerMessage(message)
+    finally:
+        metrics.tracing(None)
+        if message.trace is not None:
+            metrics.writeTrace({"received": message.received, "channel": message.channel, "text": message.text,
+                                "seconds": round(time() - message.received, 4), "stages": message.trace})
+
+def answerMessage(message):
+    # Runs an invoked message's search against each selected provider and posts the replies.
+    if message.search.more:
+        continueSearch(message)
+        return
+
+    # Check whether there were quotes in the message. If not, read back later.
+    if not (message.search.string and message.search.providers):
+        if message.search.help:
+            if not message.isDM:
+                message.response("Happy to help. Check your direct messages.")
+                # Update destination channel to the user's ID, thus sending a direct message. The channel's thread
+                # doesn't exist there, so the help goes to the top of the DM.
+                message.channel = message.user
+                message.thread = None
+            message.response(help_string)
+        else:
+            message.response("No search parameters found.")
+        return
+    # Check to ensure there's no characters we can't turn into a URL.
+    try:
+        str(message.search.string)
+    except UnicodeEncodeError as e:
+        message.search.string = message.search.string.encode("ascii", "ignore")
+        logger.debug("Searching for %s with the characters a URL can't have dropped", message.search.string)
+    cursors.start((message.channel, message.thread))
+    searchProviders(message, collections.OrderedDict((name, providers[name][1])
+                                                     for name in message.search.providers))
+
+def isMessageEvent(event):
+    # Only user messages can invoke the bot. Other RTM events (presence, typing, hello...) are skipped.
+    if event.get("type") != "message":
+        return False
+    for key in ("text", "channel", "user"):
+        if key not in event:
+            return False
+    return True
+
+def waitForEvents(client, timeout):
+    # Blocks until the RTM websocket has data to read or the timeout passes. Returns True if there is data.
+    try:
+        sock = client.server.websocket.sock
+    except AttributeError:
+        # No connection to wait on. Let rtm_read raise so the caller reconnects.
+        return True
+    if sock is None:
+        return True
+    # Records already decrypted into the SSL buffer don't make the socket readable again
+    if hasattr(sock, "pending") and sock.pending():
+        return True
+    readable, writable, errored = select.select([sock], [], [sock], timeout)
+    return bool(readable or errored)
+
+class batch_query:
+    # One query read by --batch. It has a search like a Slack message does, and collects the notes a reply would
+    # have had, e.g. that a provider was down and the results are from earlier.
+    def __init__(self, number, search):
+        self.number = number
+        self.search = search
+        self.notes = []
+
+    def add(self, text):
+        self.notes.append(text.strip("_\n "))
+
+def parseBatchLine(number, line):
+    # Reads one line of --batch input into a batch_query. Raises ValueError if it isn't a query.
+    if line.lstrip().startswith("{"):
+        fields = json.loads(line)
+        if not isinstance(fields, dict):
+            raise ValueError("Expected a JSON object")
+        provider, query, limit = fields.get("provider"), fields.get("query"), fields.get("limit")
+    else:
+        fields = line.decode("utf-8").rstrip("\r\n").split("\t")
+        if len(fields) not in (2, 3):
+            raise ValueError("Expected provider<TAB>query[<TAB>limit]")
+        provider, query, limit = (fields + [None])[:3]
+    command = message_router.commands.get(unicode(provider).lower(), (None, False, {}))[2]
+    if not command.get("providers"):
+        raise ValueError("Unknown provider: %s" % provider)
+    if not query:
+        raise ValueError("No query")
+    parsed = search(True)
+    vars(parsed).update(command)
+    parsed.invoked = True
+    parsed.string = unicode(query)
+    # Check to ensure there's no characters we can't turn into a URL, as for messages
+    try:
+        str(parsed.string)
+    except UnicodeEncodeError:
+        parsed.string = parsed.string.encode("ascii", "ignore")
+    if limit in (None, ""):
+        parsed.result_limit = result_limit
+    elif unicode(limit).lower() == "none":
+        parsed.result_limit = 999999
+    else:
+        parsed.result_limit = int(limit)
+    if len(parsed.providers) == 1 and not parsed.textonly:
+        parsed.ids = directIds(parsed.providers[0], parsed.string)
+    return batch_query(number, parsed)
+
+def zdName(table, id):
+    # The directory entry for a user or org ID, or None if it isn't known (yet)
+    try:
+        return table[id]
+    except KeyError:
+        return None
+
+def batchZendesk(query):
+    # Returns a batch query's Zendesk tickets, with the users and org named, and whether there are more
+    rest = None
+    tickets = getZDTicketsById(zd_client, query.search.ids) if query.search.ids else None
+    # With no such tickets, search for the text instead
+    if not tickets:
+        params = dict(zd_params, query=query.search.string)
+        tickets, rest = cachedSearch("zendesk", "zendesk", query,
+                                     lambda: getZDTickets(zd_client, params, query.search.result_limit), query)
+    # Unlike a reply, which can't keep someone waiting, a batch waits a while for the directory so its output names
+    # people rather than giving raw IDs. It only waits once for the whole batch.
+    if not zd_dir.isReady():
+        logger.info("Waiting for the Zendesk directory to download before writing Zendesk results")
+        if not zd_dir.ready.wait(max(batch_directory_deadline - time(), 0)):
+            logger.warning("The Zendesk directory isn't ready after %d seconds. Writing raw user and org IDs.",
+                           zd_directory_wait, extra={"sample": "directory"})
+            query.add("The Zendesk directory isn't ready yet, so users and orgs are only given by ID.")
+    resolveZDIds(tickets)
+    return [dict(ticket, url="https://cumulusnetworks.zendesk.com/agent/tickets/%s" % ticket["id"],
+                 submitter=zdName(zd_users, ticket.get("submitter_id")),
+                 assignee=zdName(zd_users, ticket.get("assignee_id")),
+                 organization=zdName(zd_orgs, ticket.get("organization_id")))
+            for ticket in tickets], rest is not None
+
+def batchJira(query):
+    # Returns a batch query's JIRA issue records and whether there are more
+    rest = None
+    if query.search.ids:
+        issues = getJiraIssuesByKey(jira, query.search.ids)
+    else:
+        issues, rest = cachedSearch("jira", "jira:text" if query.search.textonly else "jira", query,
+                                    lambda: getJiraTickets(jira, query.search.string, query.search.textonly,
+                                                           query.search.result_limit), query)
+    return [dict(issue, url="https://tickets.cumulusnetworks.com/browse/%s" % issue["key"]) for issue in issues], \
+        rest is not None
+
+def batchSalesforce(query):
+    # Returns a batch query's Salesforce records, in the order replies list them, and whether there are more
+    records, rest = cachedSearch("salesforce", "salesforce", query,
+                                 lambda: salesforce.getRecords(query.search.string, query.search.result_limit),
+                                 query)
+    found = []
+    for r_type in sf_fields:
+        for record in records.get(r_type, []):
+            record = dict((field, value) for field, value in record.items() if field != "attributes")
+            found.append(dict(record, type=r_type, url="https://%s/%s" % (salesforce.instance(), record["Id"])))
+    return found, rest is not None
+
+# Provider name -> function returning a batch query's results from it
+batch_providers = {
+    "zendesk": batchZendesk,
+    "jira": batchJira,
+    "salesforce": batchSalesforce,
+}
+
+def errorText(e):
+    # An error's message as unicode, whether it was raised with unicode or with UTF-8 bytes
+    try:
+        return unicode(e)
+    except UnicodeDecodeError:
+        return str(e).decode("utf-8", "replace")
+
+def runBatchQuery(number, line):
+    # Runs one line of --batch input against each of its providers in turn, through the same caches, rate limits
+    # and circuit breakers as the bot. Returns a result for each provider, or one for the line if it's no good.
+    try:
+        query = parseBatchLine(number, line)
+    except ValueError as e:
+        return [{"line": number, "error": errorText(e)}]
+    results = []
+    for name in query.search.providers:
+        result = {"line": number, "provider": name, "query": query.search.string,
+                  "limit": query.search.result_limit}
+        del query.notes[:]
+        setSearchDeadline(time() + provider_deadlines[name])
+        try:
+            with metrics.timed("provider", provider=name):
+                result["results"], result["more"] = batch_providers[name](query)
+        except JIRAError as e:
+            result["error"] = e.text
+        except Exception as e:
+            result["error"] = errorText(e)
+        if query.notes:
+            result["notes"] = list(query.notes)
+        results.append(result)
+    setSearchDeadline(None)
+    return results
+
+def runBatch(source, parallel, refresh_cache=False):
+    # Runs the queries read from source, a file name or - for stdin, parallel at a time. Each provider's results
+    # are written to stdout as a line of JSON as soon as they're ready, so they may be out of order; each says
+    # which line it answers. The log goes to stderr as usual.
+    output = sys.stdout
+    global workers
+    workers = parallel
+    startClients(refresh_cache)
+    global batch_directory_deadline
+    batch_directory_deadline = time() + zd_directory_wait
+    lines = sys.stdin if source == "-" else open(source)
+
+    queries = pool(parallel, "batch")
+    write_lock = threading.Lock()
+    # Read ahead only a little, so a big file isn't all queued at once
+    slots = threading.Semaphore(parallel * 2)
+    def run(number, line):
+        try:
+            results = runBatchQuery(number, line)
+            with write_lock:
+                for result in results:
+                    output.write(json.dumps(result) + "\n")
+                output.flush()
+        finally:
+            slots.release()
+
+    started = time()
+    count = 0
+    # readline rather than iterating, which reads ahead, so queries piped in start straight away
+    for number, line in enumerate(iter(lines.readline, ""), 1):
+        if not line.strip() or line.startswith("#"):
+            continue
+        slots.acquire()
+        queries.submit(run, number, line)
+        count += 1
+    # Wait for the last queries to finish
+    for i in range(parallel * 2):
+        slots.acquire()
+    logger.info("Ran %d queries in %.1f seconds", count, time() - started)
+
+def configure(cfg):
+    # Sets up the bot from the parsed configuration file
 
     ### Zendesk ###
     zencfg = cfg["zendesk"]
@@ -527,19 +2376,53 @@ if __name__ == "__main__":
     zd_domain = zencfg["subdomain"]
     global zd_credentials
     zd_credentials = zencfg["email"], zencfg["password"]
+    global zd_options
+    zd_options = {
+        "subdomain": zd_domain,
+        "credentials": zd_credentials,
+        # Only needed to point the bot at something other than <subdomain>.zendesk.com
+        "url": zencfg.get("url"),
+        "connect_timeout": zencfg.get("connect_timeout", 5),
+        "read_timeout": zencfg.get("read_timeout", 20),
+        "retries": zencfg.get("retries", 3),
+        "backoff": zencfg.get("backoff", 0.5),
+        "max_backoff": zencfg.get("max_backoff", 30),
+    }
+    global zd_directory_cache
+    zd_directory_cache = zencfg.get("directory_cache", "/tmp/zd_directory.sqlite")
+    global zd_sync_interval
+    # Seconds between syncs of users and orgs changed in Zendesk
+    zd_sync_interval = zencfg.get("sync_interval", 300)
+    global zd_resolve_budget
+    # Seconds a reply may spend looking up users and orgs newer than the last sync
+    zd_resolve_budget = zencfg.get("resolve_budget", 2)
+    global zd_directory_wait
+    # Seconds --batch waits for the directory to download, if it hasn't yet, before giving raw user and org IDs
+    zd_directory_wait = zencfg.get("directory_wait", 300)
     global zd_params
     zd_params = {
         'sort_by': 'created_at',
         'sort_order': 'desc'
     }
 
+    global provider_deadlines
+    # Seconds each provider has to reply before its results are dropped
+    provider_deadlines = {"zendesk": zencfg.get("deadline", 30)}
+
     ### JIRA ###
     jrcfg = cfg["jira"]
+    global jr_options
     jr_options = {
         "server": jrcfg["server"],
         "username": jrcfg["username"],
         "password": jrcfg["password"],
+        # Seconds to wait for JIRA to connect and for each response
+        "timeout": jrcfg.get("timeout", 20),
+        # The JIRA library waits 10 seconds or more between retries, which uses up most of the deadline, so by
+        # default a failure is left to the circuit breaker instead
+        "retries": jrcfg.get("retries", 0),
     }
+    provider_deadlines["jira"] = jrcfg.get("deadline", 30)
 
     ### Slack ###
     slkcfg = cfg["slack"]
@@ -550,17 +2433,96 @@ if __name__ == "__main__":
 
     ### SalesForce ###
     sfcfg = cfg["salesforce"]
+    global sf_options
     sf_options = {
         "username" : sfcfg["username"],
         "password" : sfcfg["password"],
-        "token" : sfcfg["security_token"]
+        "token" : sfcfg["security_token"],
+        "timeout": sfcfg.get("timeout", 20),
     }
+    provider_deadlines["salesforce"] = sfcfg.get("deadline", 30)
+
+    global provider_options
+    # Outages in a row before a provider's circuit breaker opens, seconds before it's tried again, and whether
+    # slow calls are hedged with a second one
+    provider_options = {}
+    for name, provcfg in (("zendesk", zencfg), ("jira", jrcfg), ("salesforce", sfcfg)):
+        provider_options[name] = {
+            "breaker_failures": provcfg.get("breaker_failures", 5),
+            "breaker_cooldown": provcfg.get("breaker_cooldown", 30),
+            "hedge": provcfg.get("hedge", False),
+        }
 
     ### General ###
     gencfg = cfg["general"]
     global result_limit
     result_limit = gencfg["result_limit"]
+    global workers
+    # Number of messages searched at the same time
+    workers = gencfg.get("workers", 4)
+    indexcfg = cfg.get("local_search", {})
+    global index_options
+    index_options = {
+        "enabled": indexcfg.get("enabled", False),
+        "path": indexcfg.get("path", "/tmp/rocketsearch_index.sqlite"),
+        # Seconds between syncs of tickets and issues changed since the last one
+        "sync_interval": indexcfg.get("sync_interval", 300),
+        # Optional JQL limiting which JIRA issues are indexed, e.g. "project in (CM, FR)"
+        "jql": indexcfg.get("jql", ""),
+        # Searches whose every word is in more documents than this go to the provider instead
+        "max_postings": indexcfg.get("max_postings", 20000),
+    }
 
+    logcfg = cfg.get("logging", {})
+    # Longest payload, e.g. an RTM event or a reply, written to the log before it's cut short
+    truncated.limit = logcfg.get("payload_limit", 500)
+    # Per-event debug output, e.g. each RTM event, is written for one in this many events. 1 writes it all.
+    log_sampling.every = logcfg.get("sample_every", 10)
+    # Log lines as JSON rather than text
+    if logcfg.get("json"):
+        for handler in logging.getLogger().handlers:
+            handler.setFormatter(json_formatter())
+
+    cachecfg = cfg.get("cache", {})
+    global cache_ttl
+    # Seconds a provider's results are reused for the same query. 0 turns the cache off.
+    cache_ttl = cachecfg.get("ttl", 300)
+    global cache_size
+    # Most results kept before the least recently used are dropped
+    cache_size = cachecfg.get("size", 256)
+    global record_ttl
+    # Seconds a ticket or issue looked up by ID is reused for
+    record_ttl = cachecfg.get("record_ttl", 60)
+    global cache_path
+    # File shared by the bot processes on a host, so each can use results the others fetched. Off if not set.
+    cache_path = cachecfg.get("path")
+    global cursor_ttl
+    # Seconds after a search that "more" can continue it
+    cursor_ttl = cachecfg.get("cursor_ttl", 600)
+    ratecfg = cfg.get("rate_limits", {})
+    global rate_limits
+    # Destination -> (calls a second, burst). Slack's is for each channel. Zendesk's follows the limit it reports.
+    rate_limits = {}
+    for destination, rate, burst in (("zendesk", 10, 20), ("jira", 20, 20), ("salesforce", 20, 20), ("slack", 1, 3)):
+        limits = ratecfg.get(destination, {})
+        rate_limits[destination] = (limits.get("rate", rate), limits.get("burst", burst))
+    metricscfg = cfg.get("metrics", {})
+    global metrics_options
+    metrics_options = {
+        # Port to serve Prometheus metrics on. 0 turns the endpoint off.
+        "port": metricscfg.get("port", 0),
+        "address": metricscfg.get("address", "127.0.0.1"),
+        # File to append a JSON line to for each message handled, listing how long each stage took
+        "trace_log": metricscfg.get("trace_log"),
+    }
+    global message_limit
+    # Longest reply posted as one message. Longer replies are split between results.
+    message_limit = slkcfg.get("message_limit", 3500)
+    global rtm_idle_timeout
+    # Longest time the RTM reader waits for Slack before checking the connection again
+    rtm_idle_timeout = slkcfg.get("idle_timeout", 30)
+
+    global help_string
     help_string = """*_A handy Slack bot made by slaffer to search Zendesk and JIRA._*
 
 *Full Examples (i.e. the TL;DR notes):*
@@ -615,6 +2577,14 @@ This searches both Zendesk and JIRA for the following text. Multiple words or st
 > Directly:
 >  - `text "<words>"`
 
+*Searching live:*
+If the local index is turned on, plain word searches of Zendesk and text searches are answered from it. Add `live`\
+ after your query to search Zendesk and JIRA directly. Queries with operators are always searched live.
+> In a channel:
+>  - `@rocketsearch text "<words>" live`
+> Directly:
+>  - `zendesk "<words>" live`
+
 *Limiting results:*
 By default, a maximum of 5 results are returned per provider. You can change this limit by appending\
  `limit=<number>` or `limit=None` to your query.
@@ -623,9 +2593,17 @@ By default, a maximum of 5 results are returned per provider. You can change thi
 > Directly:
 >  - `text "<words>" limit=none`
 
+*More results:*
+When there are more results than the limit, the reply says so. Send `more` in the same channel or thread soon\
+ after to see the next page, rather than searching again with a bigger limit.
+> In a channel:
+>  - `@rocketsearch more`
+> Directly:
+>  - `more`
+
 *Searching Salesforce:*
 This uses Salesforce quick search and returns matching Accounts, Contacts, Leads and Users. Can be called with "sf"\
-or "salesforce". No limits apply to Salesforce queries.
+or "salesforce". Results are limited the same way as the other providers.
 > In a channel:
 >  - `@rocketsearch sf "<text>"`
 > Directly:
@@ -635,5 +2613,141 @@ or "salesforce". No limits apply to Salesforce queries.
 Please open a JIRA ticket in the GSS project and assign it to @slaffer.
 """
 
-    main()
+def startClients(refresh_cache=False):
+    # Sets up the provider clients, caches and pools that the bot and --batch share
+
+    # Rate limits for everything the bot calls
+    global outbound
+    outbound = scheduler(rate_limits)
+    # Circuit breakers and hedging for each provider's searches
+    global upstreams
+    upstreams = dict((name, upstream(name, provider_options[name])) for name in providers)
+    # One Zendesk client shared by everything that calls Zendesk at once: the workers ("more" and directory
+    # lookups), the provider pool's searches, their hedged second calls when hedging is on, and the directory and
+    # index syncs. Connections beyond the pool size would be thrown away after each call.
+    global zd_client
+    searches = workers * len(providers)
+    hedges = searches if provider_options["zendesk"]["hedge"] else 0
+    zd_client = zendesk(zd_options, workers + searches + hedges + 2)
+    # Likewise for JIRA, which logs in on the first search
+    global jira
+    jira = jira_session(jr_options)
+    # And for Salesforce
+    global salesforce
+    salesforce = sfdc(sf_options)
+    # Text searches can be answered from a local index instead, if it's turned on
+    global local_index
+    local_index = None
+    if index_options["enabled"]:
+        local_index = search_index(index_options["path"], zd_client, jira, index_options["jql"],
+                                   index_options["max_postings"])
+        local_index.start(index_options["sync_interval"])
+    # Recent results from all three, shared by every worker
+    global search_cache
+    search_cache = result_cache(cache_ttl, cache_size, shared_results(cache_path) if cache_path else None)
+    metrics.gauge("rocketsearch_cache_entries", lambda: len(search_cache.results))
+    # Tickets and issues looked up by ID
+    global record_lookups
+    record_lookups = record_cache(record_ttl, cache_size * 4)
+    # Where each channel's last search got to, for "more"
+    global cursors
+    cursors = cursor_store(cursor_ttl)
+    if metrics_options["trace_log"]:
+        metrics.openTrace(metrics_options["trace_log"])
+    if metrics_options["port"]:
+        metrics.serve(metrics_options["address"], metrics_options["port"])
+
+    # Get all ZD Users and Orgs. Unless asked to refresh from scratch, keep the stored directory and only
+    # download what changed since the last sync. This happens in the background so the bot can connect to
+    # Slack straight away.
+    store = zd_store(zd_directory_cache)
+    if refresh_cache:
+        store.clear()
+    global zd_users, zd_orgs
+    zd_users = zd_table(store, "users", ["name", "email"])
+    zd_orgs = zd_table(store, "orgs", ["name"])
+    logger.info("Zendesk directory has %d users and %d orgs", len(zd_users), len(zd_orgs))
+    global zd_dir
+    zd_dir = zd_directory(zd_client, store)
+    if not zd_dir.ready.is_set():
+        logger.info("Downloading the Zendesk directory. Replies show raw user and org IDs until it's ready.")
+    zd_dir.start(zd_sync_interval)
+    metrics.gauge("rocketsearch_directory_ready", lambda: int(zd_dir.ready.is_set()))
+
+    # Built once here rather than per message
+    global message_router
+    message_router = buildRouter(slackBot, result_limit)
+
+    # Each message can have every provider searching at once
+    global provider_pool
+    provider_pool = pool(workers * len(providers), "provider")
+    # Room for each of those searches to have a hedged call in flight too
+    global hedge_pool
+    hedge_pool = pool(workers * len(providers) * 2, "hedge")
+
+def main(refresh_cache=False):
+    startClients(refresh_cache)
+
+    # Instantiate Slack API object
+    global rocketsearch
+    rocketsearch = SlackClient(slackToken)
+
+    # Searches run on a pool of workers so the RTM reader below never waits on a provider
+    messages = dispatcher(handleMessage, workers)
+    metrics.gauge("rocketsearch_queue_depth", messages.depth)
+
+    # Connect to Slack Real-Time Messaging
+    if rocketsearch.rtm_connect():
+        logger.info("RocketSearch: connected and running!")
+        while True:
+            try:
+                # Block until Slack sends something rather than polling on a timer
+                waitForEvents(rocketsearch, rtm_idle_timeout)
+                # A single read can return several events, so handle all of them
+                with metrics.timed("rtm_read"):
+                    events = rocketsearch.rtm_read()
+                metrics.count("rocketsearch_rtm_events_total", len(events))
+                for event in events:
+                    logger.debug("RTM event: %s", truncated(event), extra={"sample": "rtm_event"})
+                    if not isMessageEvent(event):
+                        continue
+                    message = slack(message=event)
+                    # If the bot didn't send it, check whether the bot was invoked. If so, queue it for a worker.
+                    if message.text and not message.isBot and message.checkInvoked():
+                        messages.submit(message)
+            except websocket._exceptions.WebSocketConnectionClosedException as e:
+                sleep(10)
+                logger.warning("Connection to Slack RTM dropped. Attempting to reconnect.")
+                if rocketsearch.rtm_connect():
+                    logger.info("Successfully reconnected!")
+                    pass
+                else:
+                    logger.warning("Still can't connect. Trying again.")
+                    continue
+
+if __name__ == "__main__":
+
+    arguments = docopt(__doc__)
+
+    ### Logging ###
+    level = logging.getLevelName(arguments["--level"].upper())
+    if not isinstance(level, int):
+        exit("Unknown logging level %s" % arguments["--level"])
+    logging.basicConfig(level=level, format=log_format)
+
+    ### Configuration ###
+    if "~" in arguments['--config']:
+        pattern = re.compile('~')
+        arguments['--config'] = pattern.sub(os.path.expanduser("~"), arguments['--config'])
+    if not os.path.exists(arguments['--config']):
+        logger.error("Specified configuration file does not exist!")
+        exit(1)
+    with open(arguments['--config'], 'r') as ymlfile:
+        cfg = yaml.load(ymlfile)
+
+    configure(cfg)
+    if arguments["--batch"]:
+        runBatch(arguments["--batch"], int(arguments["--parallel"]), arguments["--refresh-cache"])
+    else:
+        main(arguments["--refresh-cache"])
     exit(0)